@@ -0,0 +1,53 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import imageio
+
+from run_nerf_helpers import to8b
+
+
+class FrameWriter:
+    '''
+    Writes rendered frames off the render loop. PNGs are encoded by a pool of
+    threads, frames of a video are appended in order by one extra thread to an
+    mp4 writer that stays open until close().
+    At most max_pending frames wait to be written, so host memory does not
+    grow with the length of the path. Errors of the writer threads are raised
+    in the render loop.
+    '''
+    def __init__(self, n_threads=4, max_pending=16):
+        self.png_pool = ThreadPoolExecutor(n_threads)
+        self.video_pool = ThreadPoolExecutor(1)
+        self.videos = {}
+        self.pending = collections.deque()
+        self.max_pending = max_pending
+
+    def _submit(self, pool, fn, *args):
+        self.pending.append(pool.submit(fn, *args))
+        while len(self.pending) > self.max_pending or (len(self.pending) > 0 and self.pending[0].done()):
+            self.pending.popleft().result()
+
+    def write_png(self, filename, img):
+        # img: H x W x 3 in [0, 1]
+        self._submit(self.png_pool, imageio.imwrite, filename, to8b(img))
+
+    def append_video(self, filename, frame, fps=30, quality=8):
+        # frame: H x W (x 3) in [0, 1]
+        if filename not in self.videos:
+            self.videos[filename] = imageio.get_writer(filename, fps=fps, quality=quality)
+        self._submit(self.video_pool, self.videos[filename].append_data, to8b(frame))
+
+    def close(self):
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+        for video in self.videos.values():
+            video.close()
+        self.videos = {}
+        self.png_pool.shutdown()
+        self.video_pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
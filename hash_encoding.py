@@ -6,74 +6,295 @@ import numpy as np
 import pdb
 from torch.autograd import Variable
 
-from utils import get_voxel_vertices
+from utils import hash, get_voxel_vertices, get_voxel_vertices_precomputed, get_voxel_bottom_left, \
+                  unique_voxel_vertices, hash_collision_rate
 
 class HashEmbedder(nn.Module):
     def __init__(self, bounding_box, n_levels=16, n_features_per_level=2,\
-                log2_hashmap_size=19, base_resolution=16, finest_resolution=512):
+                log2_hashmap_size=19, base_resolution=16, finest_resolution=512, sync_free=True,
+                fused_backward=False, dtype=torch.float32, dedup=False):
         super(HashEmbedder, self).__init__()
         self.bounding_box = bounding_box
+        self.sync_free = sync_free
+        self.fused_backward = fused_backward
+        self.dedup = dedup
         self.n_levels = n_levels
         self.n_features_per_level = n_features_per_level
         self.log2_hashmap_size = log2_hashmap_size
         self.base_resolution = torch.tensor(base_resolution)
         self.finest_resolution = torch.tensor(finest_resolution)
         self.out_dim = self.n_levels * self.n_features_per_level
+        # levels >= n_active_levels are skipped (coarse-to-fine training)
+        self.n_active_levels = n_levels
 
         self.b = torch.exp((torch.log(self.finest_resolution)-torch.log(self.base_resolution))/(n_levels-1))
 
-        self.embeddings = nn.ModuleList([nn.Embedding(2**self.log2_hashmap_size, \
-                                        self.n_features_per_level) for i in range(n_levels)])
+        resolutions = torch.stack([torch.floor(self.base_resolution * self.b**i) for i in range(n_levels)])
+        self.register_buffer('resolutions', resolutions, persistent=False)
+
+        # per-level grid constants for the sync-free lookup
+        box_min, box_max = [torch.as_tensor(v).float() for v in bounding_box]
+        grid_size = (box_max-box_min)/resolutions.to(box_min.device)[:,None,None] # L x 1 x 3
+        idx_max = torch.floor((box_max-box_min)/grid_size).int() # L x 1 x 3
+        self.register_buffer('box_min', box_min, persistent=False)
+        self.register_buffer('box_max', box_max, persistent=False)
+        self.register_buffer('grid_size', grid_size, persistent=False)
+        self.register_buffer('idx_max', idx_max, persistent=False)
+
+        # coarse levels whose vertices all fit into 2**log2_hashmap_size rows are
+        # stored as dense grids, only the finer levels are hashed
+        self.grid_sides = idx_max[:,0,:].long().cpu() + 2 # corners go up to idx_max+1
+        self.n_dense_levels = 0
+        while self.n_dense_levels < n_levels and \
+                self.grid_sides[self.n_dense_levels].prod() <= 2**self.log2_hashmap_size:
+            self.n_dense_levels += 1
+        dense_sides = self.grid_sides[:self.n_dense_levels]
+        dense_strides = torch.stack([torch.ones_like(dense_sides[:,0]), dense_sides[:,0],
+                                     dense_sides[:,0]*dense_sides[:,1]], -1) # L_dense x 3
+        self.register_buffer('dense_strides', dense_strides.int().to(box_min.device), persistent=False)
+
+        # one table for all levels: level i owns rows [offsets[i], offsets[i+1])
+        self.level_sizes = [int(side.prod()) for side in dense_sides] + \
+                           [2**self.log2_hashmap_size for i in range(self.n_dense_levels, n_levels)]
+        offsets = np.cumsum([0] + self.level_sizes)
+        # the table may be stored in fp16/bf16, interpolation always runs in fp32
+        self.embeddings = nn.Embedding(int(offsets[-1]), self.n_features_per_level, dtype=dtype)
+        self.register_buffer('offsets', torch.tensor(offsets[:-1], dtype=torch.int32, device=box_min.device), persistent=False)
+
+        # table instrumentation, see start_monitoring()
+        self._touched = None
+
         # custom uniform initialization
-        for i in range(n_levels):
-            nn.init.uniform_(self.embeddings[i].weight, a=-0.0001, b=0.0001)
-            # self.embeddings[i].weight.data.zero_()
+        nn.init.uniform_(self.embeddings.weight, a=-0.0001, b=0.0001)
+        # self.embeddings.weight.data.zero_()
         
 
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        if prefix + 'embeddings.0.weight' in state_dict:
+            # one nn.Embedding per level, saved before the fused table
+            error_msgs.append('HashEmbedder: the checkpoint stores one table per level (embeddings.N.weight). '
+                              'It predates the fused table and was trained with every lookup clamped to the '
+                              'last voxel, so it cannot be converted. Train from scratch with --no_reload.')
+        super(HashEmbedder, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                        missing_keys, unexpected_keys, error_msgs)
+
     def trilinear_interp(self, x, voxel_min_vertex, voxel_max_vertex, voxel_embedds):
         '''
         x: B x 3
-        voxel_min_vertex: B x 3
-        voxel_max_vertex: B x 3
-        voxel_embedds: B x 8 x 2
+        voxel_min_vertex: (L x) B x 3
+        voxel_max_vertex: (L x) B x 3
+        voxel_embedds: (L x) B x 8 x 2
         '''
         # source: https://en.wikipedia.org/wiki/Trilinear_interpolation
-        weights = (x - voxel_min_vertex)/(voxel_max_vertex-voxel_min_vertex) # B x 3
+        weights = (x - voxel_min_vertex)/(voxel_max_vertex-voxel_min_vertex) # (L x) B x 3
 
         # step 1
         # 0->000, 1->001, 2->010, 3->011, 4->100, 5->101, 6->110, 7->111
-        c00 = voxel_embedds[:,0]*(1-weights[:,0][:,None]) + voxel_embedds[:,4]*weights[:,0][:,None]
-        c01 = voxel_embedds[:,1]*(1-weights[:,0][:,None]) + voxel_embedds[:,5]*weights[:,0][:,None]
-        c10 = voxel_embedds[:,2]*(1-weights[:,0][:,None]) + voxel_embedds[:,6]*weights[:,0][:,None]
-        c11 = voxel_embedds[:,3]*(1-weights[:,0][:,None]) + voxel_embedds[:,7]*weights[:,0][:,None]
+        # c00, c01, c10, c11 in one lerp over the 4 corner pairs
+        c_ = torch.lerp(voxel_embedds[...,:4,:], voxel_embedds[...,4:,:], weights[...,0][...,None,None])
 
         # step 2
-        c0 = c00*(1-weights[:,1][:,None]) + c10*weights[:,1][:,None]
-        c1 = c01*(1-weights[:,1][:,None]) + c11*weights[:,1][:,None]
+        # c0, c1
+        c_ = torch.lerp(c_[...,:2,:], c_[...,2:,:], weights[...,1][...,None,None])
 
         # step 3
-        c = c0*(1-weights[:,2][:,None]) + c1*weights[:,2][:,None]
+        c = torch.lerp(c_[...,0,:], c_[...,1,:], weights[...,2][...,None])
 
         return c
 
-    def forward(self, x, di_levels=None):
-        # x is 3D point position: B x 3
-        # di: n_levels x B x 3
-        if di_levels is None:
-            di_levels = torch.zeros((self.n_levels, x.shape[0], 3))	
-        x_embedded_all = []
+    def vertex_rows(self, vertices, levels):
+        '''
+        Table rows of integer vertex coordinates, dense levels by their grid
+        strides, the finer levels hashed.
+        vertices: N x 3 (int32), levels: N, the level of each vertex
+        '''
+        rows = hash(vertices, self.log2_hashmap_size)
+        if self.n_dense_levels > 0:
+            dense = levels < self.n_dense_levels
+            strides = self.dense_strides[torch.clamp(levels, max=self.n_dense_levels-1)]
+            rows = torch.where(dense, (vertices * strides).sum(-1), rows)
+        return rows + self.offsets[levels]
+
+    def start_monitoring(self):
+        # record touched rows and per-row gradient norms until stop_monitoring(),
+        # only forward passes with grad enabled (training steps) are recorded
+        rows = self.embeddings.weight.shape[0]
+        device = self.embeddings.weight.device
+        self._touched = torch.zeros(rows, dtype=torch.bool, device=device)
+        self._grad_norm_sum = torch.zeros(rows, device=device)
+        self._n_grad_steps = 0
+        self._last_batch = None
+        self._grad_hook = self.embeddings.weight.register_hook(self._accumulate_grad_norm)
+
+    def stop_monitoring(self):
+        self._grad_hook.remove()
+        self._touched = None
+
+    def _accumulate_grad_norm(self, grad):
+        self._grad_norm_sum += grad.detach().float().norm(dim=-1)
+        self._n_grad_steps += 1
+
+    def table_stats(self, x=None, di_levels=None, reset=True):
+        '''
+        Per-level table usage since start_monitoring() or the last reset:
+          touched: rows read at least once
+          collision_rate: share of the distinct vertices of x (default: the
+            last batch seen) that do not get a slot of their own
+          grad_mean, grad_max: per-row gradient norm averaged over the
+            backward passes of the window, over the touched rows
+        '''
+        if x is None and self._last_batch is not None:
+            x, di_levels = self._last_batch
+        bottom_left_idx = None
+        if x is not None:
+            bottom_left_idx = get_voxel_bottom_left(x, self.box_min, self.box_max, \
+                                                    self.grid_size, self.idx_max, di_levels)
+
+        stats = []
+        grad_norm = self._grad_norm_sum / max(self._n_grad_steps, 1)
         for i in range(self.n_levels):
-            resolution = torch.floor(self.base_resolution * self.b**i)
+            rows = slice(int(self.offsets[i]), int(self.offsets[i]) + self.level_sizes[i])
+            touched = self._touched[rows]
+            level_grad = grad_norm[rows][touched]
+            collision_rate = None
+            if bottom_left_idx is not None:
+                collision_rate = 0. if i < self.n_dense_levels else \
+                    hash_collision_rate(unique_voxel_vertices(bottom_left_idx[i]), self.log2_hashmap_size)
+            stats.append({
+                'level': i,
+                'resolution': int(self.resolutions[i]),
+                'dense': i < self.n_dense_levels,
+                'slots': self.level_sizes[i],
+                'touched': int(touched.sum()),
+                'collision_rate': collision_rate,
+                'grad_mean': level_grad.mean().item() if len(level_grad) > 0 else 0.,
+                'grad_max': level_grad.max().item() if len(level_grad) > 0 else 0.,
+            })
+
+        if reset:
+            self._touched.zero_()
+            self._grad_norm_sum.zero_()
+            self._n_grad_steps = 0
+        return stats
+
+    def voxel_vertices(self, x, di_levels=None):
+        # voxel corners of x and the table rows of their 8 vertices, for the active levels
+        n = self.n_active_levels
+        if di_levels is not None:
+            di_levels = di_levels[:n]
+        if self.sync_free:
+            voxel_min_vertex, voxel_max_vertex, hashed_voxel_indices = get_voxel_vertices_precomputed(\
+                                                x, self.box_min, self.box_max, \
+                                                self.grid_size[:n], self.idx_max[:n], self.log2_hashmap_size, di=di_levels, \
+                                                dense_strides=self.dense_strides[:n])
+        else:
             voxel_min_vertex, voxel_max_vertex, hashed_voxel_indices = get_voxel_vertices(\
                                                 x, self.bounding_box, \
-                                                resolution, self.log2_hashmap_size, di=di_levels[i])
-            
-            voxel_embedds = self.embeddings[i](hashed_voxel_indices)
+                                                self.resolutions[:n], self.log2_hashmap_size, di=di_levels, \
+                                                dense_strides=self.dense_strides[:n])
+
+        voxel_indices = hashed_voxel_indices + self.offsets[:n,None,None]
+        return voxel_min_vertex, voxel_max_vertex, voxel_indices # L x B x 3, L x B x 3, L x B x 8
+
+    def gather(self, voxel_indices, record=False):
+        # index_select backward is a plain index_add_, much cheaper than embedding_dense_backward
+        # (int64 index: index_add_ has no fast CPU path for int32)
+        if record:
+            self._touched[voxel_indices.flatten().long()] = True
+        if self.dedup:
+            # read every distinct row once, the table gradient is then added once per unique row
+            unique_indices, inverse = torch.unique(voxel_indices.flatten(), return_inverse=True)
+            rows = self.embeddings.weight.index_select(0, unique_indices.long())
+            voxel_embedds = rows.index_select(0, inverse)
+        else:
+            voxel_embedds = self.embeddings.weight.index_select(0, voxel_indices.flatten().long())
+        return voxel_embedds.view(*voxel_indices.shape, self.n_features_per_level).float() # L x B x 8 x 2
+
+    def forward(self, x, di_levels=None):
+        # x is 3D point position: B x 3
+        # di: n_levels x B x 3
+        # all active levels are computed at once on L x B x 8 corner indices
+        # no-grad passes (test renders, occupancy updates) are left out of the stats
+        record = self._touched is not None and torch.is_grad_enabled()
+        if record:
+            # copies, so that the stats do not keep the graph or the buffers of the step alive
+            self._last_batch = (x.detach().clone(), None if di_levels is None else di_levels.detach().clone())
+        if self.fused_backward:
+            x_embedded = HashGridInterpolation.apply(x, self.embeddings.weight, di_levels, self, record)
+        else:
+            voxel_min_vertex, voxel_max_vertex, voxel_indices = self.voxel_vertices(x, di_levels)
+            voxel_embedds = self.gather(voxel_indices, record)
+            x_embedded = self.trilinear_interp(x, voxel_min_vertex, voxel_max_vertex, voxel_embedds) # L x B x 2
+
+        x_embedded = x_embedded.permute(1, 0, 2).reshape(x.shape[0], -1)
+        if self.n_active_levels < self.n_levels:
+            # inactive levels give zero features, so the output width stays the same
+            x_embedded = F.pad(x_embedded, (0, self.out_dim - x_embedded.shape[-1]))
+        return x_embedded
+
+
+class HashGridInterpolation(torch.autograd.Function):
+    '''
+    Encode + trilinear interpolation of all hash levels with a hand-written
+    backward. Only x and the level offsets di are saved, corner indices and
+    interpolation weights are recomputed in backward and the table gradient
+    is scattered with a single index_add_.
+    '''
+    @staticmethod
+    def forward(ctx, x, table, di_levels, embedder, record=False):
+        voxel_min_vertex, voxel_max_vertex, voxel_indices = embedder.voxel_vertices(x, di_levels)
+        voxel_embedds = embedder.gather(voxel_indices, record)
+        x_embedded = embedder.trilinear_interp(x, voxel_min_vertex, voxel_max_vertex, voxel_embedds)
+
+        ctx.embedder = embedder
+        ctx.has_di = di_levels is not None
+        ctx.save_for_backward(x, *([di_levels] if ctx.has_di else []))
+        return x_embedded # L x B x 2
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, *di_levels = ctx.saved_tensors
+        di_levels = di_levels[0] if ctx.has_di else None
+        embedder = ctx.embedder
+        table = embedder.embeddings.weight
+
+        voxel_min_vertex, voxel_max_vertex, voxel_indices = embedder.voxel_vertices(x, di_levels)
+        voxel_size = voxel_max_vertex - voxel_min_vertex
+        weights = (x - voxel_min_vertex)/voxel_size # L x B x 3
+        # per-axis weights of the 0 and 1 corner: L x B x 3 x 2
+        w = torch.stack([1-weights, weights], -1)
+
+        grad_table = None
+        if ctx.needs_input_grad[1]:
+            # 0->000, 1->001, ..., 7->111
+            corner_weights = (w[...,0,:,None,None] * w[...,1,None,:,None] * w[...,2,None,None,:]).flatten(-3) # L x B x 8
+            grad_rows = corner_weights[...,None] * grad_out[...,None,:] # L x B x 8 x 2
+            grad_rows = grad_rows.reshape(-1, table.shape[-1])
+            grad_table = torch.zeros(table.shape, dtype=grad_rows.dtype, device=table.device)
+            if embedder.dedup:
+                unique_indices, inverse = torch.unique(voxel_indices.flatten(), return_inverse=True)
+                grad_unique = torch.zeros((unique_indices.shape[0], table.shape[-1]), dtype=grad_rows.dtype, device=table.device)
+                grad_unique.index_add_(0, inverse, grad_rows)
+                grad_table[unique_indices.long()] = grad_unique
+            else:
+                # int64 index: index_add_ has no fast CPU path for int32
+                grad_table.index_add_(0, voxel_indices.flatten().long(), grad_rows)
+            grad_table = grad_table.to(table.dtype)
 
-            x_embedded = self.trilinear_interp(x, voxel_min_vertex, voxel_max_vertex, voxel_embedds)
-            x_embedded_all.append(x_embedded)
+        grad_x = None
+        if ctx.needs_input_grad[0]:
+            e = embedder.gather(voxel_indices)
+            e = e.view(*e.shape[:-2], 2, 2, 2, e.shape[-1]) # L x B x 2 x 2 x 2 x 2
+            de_x = e[...,1,:,:,:] - e[...,0,:,:,:]
+            de_y = e[...,:,1,:,:] - e[...,:,0,:,:]
+            de_z = e[...,:,:,1,:] - e[...,:,:,0,:]
+            d_x = (de_x * (w[...,1,:,None] * w[...,2,None,:])[...,None]).sum((-3, -2))
+            d_y = (de_y * (w[...,0,:,None] * w[...,2,None,:])[...,None]).sum((-3, -2))
+            d_z = (de_z * (w[...,0,:,None] * w[...,1,None,:])[...,None]).sum((-3, -2))
+            grad_weights = torch.stack([(grad_out*d).sum(-1) for d in [d_x, d_y, d_z]], -1) # L x B x 3
+            grad_x = (grad_weights / voxel_size).sum(0)
 
-        return torch.cat(x_embedded_all, dim=-1)
+        return grad_x, grad_table, None, None, None
 
 # def linear_block(in_f, *args, **kwargs): 
 #     return nn.Sequential( nn.Linear(in_f, 256, *args, **kwargs), nn.ReLU(), nn.Linear(256, 9) )
@@ -1,46 +1,69 @@
 # Author: Yash Bhalgat
 
-from math import exp, log, floor
 import torch
 import torch.nn.functional as F
-import pdb
-
-from utils import hash
-
-
-def total_variation_loss(embeddings, min_resolution, max_resolution, level, log2_hashmap_size, n_levels=16):
-    # Get resolution
-    b = exp((log(max_resolution)-log(min_resolution))/(n_levels-1))
-    resolution = torch.tensor(floor(min_resolution * b**level))
-
-    # Cube size to apply TV loss
-    min_cube_size = min_resolution - 1
-    max_cube_size = 50 # can be tuned
-    if min_cube_size > max_cube_size:
-        print("ALERT! min cuboid size greater than max!")
-        pdb.set_trace()
-    cube_size = torch.floor(torch.clip(resolution/10.0, min_cube_size, max_cube_size)).int()
-
-    # Sample cuboid
-    min_vertex = torch.randint(0, resolution-cube_size, (3,))
-    idx = min_vertex + torch.stack([torch.arange(cube_size+1) for _ in range(3)], dim=-1)
-    cube_indices = torch.stack(torch.meshgrid(idx[:,0], idx[:,1], idx[:,2]), dim=-1)
-
-    hashed_indices = hash(cube_indices, log2_hashmap_size)
-    cube_embeddings = embeddings(hashed_indices)
-    #hashed_idx_offset_x = hash(idx+torch.tensor([1,0,0]), log2_hashmap_size)
-    #hashed_idx_offset_y = hash(idx+torch.tensor([0,1,0]), log2_hashmap_size)
-    #hashed_idx_offset_z = hash(idx+torch.tensor([0,0,1]), log2_hashmap_size)
-
-    # Compute loss
-    #tv_x = torch.pow(embeddings(hashed_idx)-embeddings(hashed_idx_offset_x), 2).sum()
-    #tv_y = torch.pow(embeddings(hashed_idx)-embeddings(hashed_idx_offset_y), 2).sum()
-    #tv_z = torch.pow(embeddings(hashed_idx)-embeddings(hashed_idx_offset_z), 2).sum()
-    tv_x = torch.pow(cube_embeddings[1:,:,:,:]-cube_embeddings[:-1,:,:,:], 2).sum()
-    tv_y = torch.pow(cube_embeddings[:,1:,:,:]-cube_embeddings[:,:-1,:,:], 2).sum()
-    tv_z = torch.pow(cube_embeddings[:,:,1:,:]-cube_embeddings[:,:,:-1,:], 2).sum()
-
-    return (tv_x + tv_y + tv_z)/cube_size
+
+
+class TotalVariationLoss:
+    '''
+    Total variation of the hash embeddings on one random cube of vertices per
+    level, all levels at once. The cube vertices, their table levels and the
+    neighbouring pairs are laid out once here, a call only draws new cube
+    positions, gathers all vertices with one index_select and takes all finite
+    differences in one pass. Only the levels below embedder.n_active_levels
+    (coarse-to-fine training) are included.
+    Same value as summing the former per-level loss over the levels:
+    sum_l (tv_x + tv_y + tv_z) / cube_size_l
+    '''
+    def __init__(self, embedder, max_cube_size=50):
+        self.embedder = embedder
+        device = embedder.embeddings.weight.device
+        resolutions = embedder.resolutions.long().cpu()
+
+        # cube size per level: resolution/10, at least min_resolution-1, at most max_cube_size
+        min_cube_size = min(int(resolutions[0]) - 1, max_cube_size)
+        cube_sizes = torch.clip(resolutions // 10, min_cube_size, max_cube_size)
+
+        offsets, levels, pairs, weights = [], [], [], []
+        n_vertices, n_pairs = 0, 0
+        # vertices and pairs are in level order: levels < l are the first level_ends[l] of each
+        self.level_ends = [(0, 0)]
+        for level, cube_size in enumerate(cube_sizes.tolist()):
+            r = torch.arange(cube_size+1)
+            cube = torch.stack(torch.meshgrid(r, r, r, indexing='ij'), dim=-1) # (c+1) x (c+1) x (c+1) x 3
+            ids = n_vertices + torch.arange(cube[...,0].numel()).view(cube.shape[:-1])
+            for a, b in [(ids[1:,:,:], ids[:-1,:,:]), (ids[:,1:,:], ids[:,:-1,:]), (ids[:,:,1:], ids[:,:,:-1])]:
+                pairs.append(torch.stack([a.flatten(), b.flatten()], dim=-1))
+                weights.append(torch.full((a.numel(),), 1./cube_size))
+                n_pairs += a.numel()
+            offsets.append(cube.view(-1, 3))
+            levels.append(torch.full((ids.numel(),), level))
+            n_vertices += ids.numel()
+            self.level_ends.append((n_vertices, n_pairs))
+
+        self.levels = torch.cat(levels).to(device) # N
+        self.cube_offsets = torch.cat(offsets).int().to(device) # N x 3
+        self.pairs = torch.cat(pairs).to(device) # P x 2
+        self.pair_weights = torch.cat(weights).to(device) # P
+        self.max_min_vertex = (resolutions - cube_sizes).float().to(device)[:,None] # L x 1
+
+    def __call__(self):
+        embedder = self.embedder
+        n_levels = min(embedder.n_active_levels, len(self.max_min_vertex))
+        n_vertices, n_pairs = self.level_ends[n_levels]
+        levels, pairs = self.levels[:n_vertices], self.pairs[:n_pairs]
+
+        # Sample one cuboid per level
+        min_vertex = (torch.rand(n_levels, 3, device=self.levels.device) \
+                        * self.max_min_vertex[:n_levels]).int() # L x 3
+        vertices = min_vertex[levels] + self.cube_offsets[:n_vertices] # N x 3
+
+        indices = embedder.vertex_rows(vertices, levels)
+        cube_embeddings = embedder.embeddings.weight.index_select(0, indices.long()).float() # N x F
+
+        # Compute loss
+        diff = cube_embeddings[pairs[:,0]] - cube_embeddings[pairs[:,1]]
+        return (diff.pow(2).sum(-1) * self.pair_weights[:n_pairs]).sum()
 
 def sigma_sparsity_loss(sigmas):
     # Using Cauchy Sparsity loss on sigma values
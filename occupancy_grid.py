@@ -0,0 +1,70 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class OccupancyGrid(nn.Module):
+    '''
+    Occupancy bitfield over the scene bounding box for empty-space skipping.
+    The scenes are dynamic, so there is one grid per time bucket: frame times
+    in [0, 1] are split into n_time_buckets equal intervals.
+    Each cell keeps a running density estimate (decayed max over updates), a
+    cell is occupied while its density is above min(threshold, mean density).
+    query() always drops samples outside the box (box culling). The cells
+    start occupied, so before the first update() only that culling applies.
+    '''
+    def __init__(self, bounding_box, resolution=64, n_time_buckets=8, threshold=0.01, decay=0.95):
+        super(OccupancyGrid, self).__init__()
+        self.resolution = resolution
+        self.n_time_buckets = n_time_buckets
+        self.threshold = threshold
+        self.decay = decay
+
+        box_min, box_max = [torch.as_tensor(v).float() for v in bounding_box]
+        self.register_buffer('box_min', box_min)
+        self.register_buffer('box_max', box_max)
+        self.register_buffer('density', torch.zeros(n_time_buckets, resolution**3))
+        self.register_buffer('occupied', torch.ones(n_time_buckets, resolution**3, dtype=torch.bool))
+
+        # integer coordinates of all cells, x-major like the flattened grid
+        r = torch.arange(resolution)
+        cells = torch.stack(torch.meshgrid(r, r, r, indexing='ij'), dim=-1).view(-1, 3)
+        self.register_buffer('cells', cells, persistent=False)
+
+    def time_bucket(self, frame_time):
+        return torch.clamp((frame_time * self.n_time_buckets).long(), 0, self.n_time_buckets-1)
+
+    def query(self, pts, frame_time):
+        '''
+        pts: ... x 3
+        frame_time: ... x 1 (broadcastable to pts[..., :1])
+        returns: ... bool, False for samples in empty cells or outside the box
+        '''
+        uvw = (pts - self.box_min) / (self.box_max - self.box_min)
+        inside = ((uvw >= 0) & (uvw < 1)).all(-1)
+        idx = torch.clamp((uvw * self.resolution).long(), 0, self.resolution-1)
+        idx = (idx[...,0] * self.resolution + idx[...,1]) * self.resolution + idx[...,2]
+        bucket = self.time_bucket(frame_time[...,0]).expand(idx.shape)
+        return inside & self.occupied[bucket, idx]
+
+    @torch.no_grad()
+    def update(self, density_fn, chunk=1024*64):
+        '''
+        Re-evaluates the density of every cell of every time bucket, at a random
+        point in the cell and a random time in the bucket.
+        density_fn: (pts N x 3, frame_time N x 1) -> sigma N
+        '''
+        cell_size = (self.box_max - self.box_min) / self.resolution
+        for t in range(self.n_time_buckets):
+            frame_time = (t + torch.rand(1, 1, device=self.density.device)) / self.n_time_buckets
+            pts = self.box_min + (self.cells + torch.rand_like(self.cells, dtype=torch.float)) * cell_size
+            sigma = torch.cat([density_fn(pts[i:i+chunk], frame_time.expand(len(pts[i:i+chunk]), 1))
+                               for i in range(0, len(pts), chunk)])
+            self.density[t] = torch.maximum(self.density[t] * self.decay, F.relu(sigma))
+
+        threshold = torch.clamp(self.density.mean(), max=self.threshold)
+        self.occupied = self.density > threshold
+
+    def occupancy(self):
+        # fraction of occupied cells per time bucket
+        return self.occupied.float().mean(-1)
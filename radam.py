@@ -21,9 +21,28 @@ class RAdam(Optimizer):
                     param['buffer'] = [[None, None, None] for _ in range(10)]
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, buffer=[[None, None, None] for _ in range(10)])
         super(RAdam, self).__init__(params, defaults)
+        # fp32 master copies of bf16 params. Not part of the state, so they are
+        # not saved: after a load they are rebuilt from the params
+        self.master_fp32 = {}
 
     def __setstate__(self, state):
         super(RAdam, self).__setstate__(state)
+        self.master_fp32 = {}
+
+    def load_state_dict(self, state_dict):
+        # Optimizer.load_state_dict casts the state to the dtype of its param,
+        # which would round the fp32 moments of bf16 params
+        saved_ids = [i for group in state_dict['param_groups'] for i in group['params']]
+        params = [p for group in self.param_groups for p in group['params']]
+        id_map = dict(zip(saved_ids, params))
+        fp32_state = {k: {name: v for name, v in s.items() if torch.is_tensor(v) and v.dtype == torch.float32}
+                      for k, s in state_dict['state'].items() if k in id_map}
+        super(RAdam, self).load_state_dict(state_dict)
+        self.master_fp32 = {}
+        for k, tensors in fp32_state.items():
+            p = id_map[k]
+            for name, v in tensors.items():
+                self.state[p][name] = v.to(p.device, copy=True)
 
     def step(self, closure=None):
 
@@ -52,6 +71,17 @@ class RAdam(Optimizer):
                     state['exp_avg'] = state['exp_avg'].type_as(p_data_fp32)
                     state['exp_avg_sq'] = state['exp_avg_sq'].type_as(p_data_fp32)
 
+                # checkpoints of older versions stored the master copy in the state
+                state.pop('master_fp32', None)
+                if p.data.dtype == torch.bfloat16:
+                    # fp32 master copy, so small updates are not rounded away. Entries
+                    # whose param was changed outside of step() restart from the param
+                    master = self.master_fp32.get(p)
+                    if master is not None:
+                        master = torch.where(master.to(p.dtype) == p.data, master, p_data_fp32)
+                    self.master_fp32[p] = p_data_fp32 = p_data_fp32 if master is None else master
+                    assert p_data_fp32.dtype == torch.float32, "master copy of a bf16 param is not fp32"
+
                 exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
                 beta1, beta2 = group['betas']
 
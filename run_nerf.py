@@ -18,7 +18,10 @@ import matplotlib.pyplot as plt
 from run_nerf_helpers import *
 from optimizer import MultiOptimizer
 from radam import RAdam
-from loss import sigma_sparsity_loss, total_variation_loss
+from loss import sigma_sparsity_loss, TotalVariationLoss
+from utils import HostSyncCounter, morton_code, checkpointed
+from occupancy_grid import OccupancyGrid
+from frame_writer import FrameWriter
 
 from load_llff import load_llff_data
 from load_deepvoxels import load_dv_data
@@ -63,13 +66,27 @@ def batchify(fn, chunk):
     """
     if chunk is None:
         return fn
-    def ret(inputs_pos, inputs_time, inputs_unembedded_pos):
+    def ret(inputs_pos, inputs_time, inputs_unembedded_pos, inputs_views=None, ray_indices=None):
         num_batches = inputs_pos.shape[0]
+        batch = chunk
+        if isinstance(ray_indices, int):
+            # whole rays in every batch
+            batch = max(chunk // ray_indices, 1) * ray_indices
 
         out_list = []
         dx_list = []
-        for i in range(0, num_batches, chunk):
-            out, dx = fn(inputs_pos[i:i+chunk], [inputs_time[0][i:i+chunk], inputs_time[1][i:i+chunk]], inputs_unembedded_pos[i:i+chunk])
+        for i in range(0, num_batches, batch):
+            if ray_indices is None:
+                out, dx = fn(inputs_pos[i:i+chunk], [inputs_time[0][i:i+chunk], inputs_time[1][i:i+chunk]], inputs_unembedded_pos[i:i+chunk])
+            elif isinstance(ray_indices, int):
+                # ray_indices consecutive points per ray, the views and times of the batch's rays
+                rays = slice(i // ray_indices, (i+batch) // ray_indices)
+                out, dx = fn(inputs_pos[i:i+batch], [t[rays] for t in inputs_time], inputs_unembedded_pos[i:i+batch],
+                             views=inputs_views[rays] if inputs_views is not None else None, ray_indices=ray_indices)
+            else:
+                # views and times are per ray, only the points are split
+                out, dx = fn(inputs_pos[i:i+chunk], inputs_time, inputs_unembedded_pos[i:i+chunk],
+                             views=inputs_views, ray_indices=ray_indices[i:i+chunk])
             out_list += [out]
             dx_list += [dx]
         return torch.cat(out_list, 0), torch.cat(dx_list, 0)
@@ -93,42 +110,88 @@ def batchify(fn, chunk):
 #    return outputs
 
 def run_network(inputs, viewdirs, frame_time, fn, embed_fn, embeddirs_fn, embedtime_fn, netchunk=1024*64,
-                embd_time_discr=True):
+                embd_time_discr=True, morton_box=None, ray_indices=None, checkpoint=()):
     """Prepares inputs and applies network 'fn'.
     inputs: N_rays x N_points_per_ray x 3
     viewdirs: N_rays x 3
-    frame_time: N_rays x 1
+    frame_time: N_rays x 1, rays may have different times
+    morton_box: (min, max) bounding box. If given, samples are sorted in Morton
+      order before the network for locality in the hash table, outputs are
+      returned in the original order.
+    ray_indices: N. If given, inputs are packed samples (N x 3) of the rays
+      ray_indices, outputs are packed as well (N x C).
+    checkpoint: stages whose activations are recomputed in the backward.
+      'encoder' applies to the input embeddings here, the network checkpoints
+      its own hash lookup and MLPs (its checkpoint attribute).
     """
-    assert len(torch.unique(frame_time)) == 1, "Only accepts all points from same time"
-    cur_time = torch.unique(frame_time)[0]
+    # the ray of every point, views and times are embedded once per ray.
+    # Unsorted points of N_rays x N_points_per_ray need no index (see add_per_ray).
+    if ray_indices is not None:
+        inputs_flat = inputs
+    else:
+        inputs_flat = torch.reshape(inputs, [-1, inputs.shape[-1]])
+        ray_indices = inputs.shape[1]
+    if morton_box is not None:
+        if isinstance(ray_indices, int):
+            ray_indices = torch.arange(inputs.shape[0], device=inputs.device).repeat_interleave(ray_indices)
+        order = torch.argsort(morton_code(inputs_flat, *morton_box))
+        inputs_flat = inputs_flat[order]
+        ray_indices = ray_indices[order]
+
+    if 'encoder' in checkpoint:
+        embed_fn, embeddirs_fn, embedtime_fn = [checkpointed(f) if f is not None else None
+                                                for f in (embed_fn, embeddirs_fn, embedtime_fn)]
 
     # embed position
-    inputs_flat = torch.reshape(inputs, [-1, inputs.shape[-1]])
     embedded = embed_fn(inputs_flat)
 
     # embed time
     if embd_time_discr:
-        B, N, _ = inputs.shape
-        input_frame_time = frame_time[:, None].expand([B, N, 1])
-        input_frame_time_flat = torch.reshape(input_frame_time, [-1, 1])
-        embedded_time = embedtime_fn(input_frame_time_flat)
+        embedded_time = embedtime_fn(frame_time)
         embedded_times = [embedded_time, embedded_time]
 
     else:
         assert NotImplementedError
 
     # embed views
+    embedded_dirs = None
     if viewdirs is not None:
-        input_dirs = viewdirs[:,None].expand(inputs.shape)
-        input_dirs_flat = torch.reshape(input_dirs, [-1, input_dirs.shape[-1]])
-        embedded_dirs = embeddirs_fn(input_dirs_flat)
-        embedded = torch.cat([embedded, embedded_dirs], -1)
-
-    outputs_flat, position_delta_flat = batchify(fn, netchunk)(embedded, embedded_times, inputs_flat)
+        embedded_dirs = embeddirs_fn(viewdirs)
+
+    outputs_flat, position_delta_flat = batchify(fn, netchunk)(embedded, embedded_times, inputs_flat,
+                                                               embedded_dirs, ray_indices)
+    if morton_box is not None:
+        # undo the sort
+        inverse_order = torch.empty_like(order)
+        inverse_order[order] = torch.arange(order.shape[0], device=order.device)
+        outputs_flat = outputs_flat[inverse_order]
+        position_delta_flat = position_delta_flat[inverse_order]
     outputs = torch.reshape(outputs_flat, list(inputs.shape[:-1]) + [outputs_flat.shape[-1]])
     position_delta = torch.reshape(position_delta_flat, list(inputs.shape[:-1]) + [position_delta_flat.shape[-1]])
     return outputs, position_delta
 
+def query_occupied(network_query_fn, pts, viewdirs, frame_time, network_fn, occupancy_grid=None):
+    """Applies network_query_fn only to the samples in occupied cells of the
+    occupancy grid. Samples in empty space get a zero raw output, i.e. zero
+    density, so they do not contribute to the rendering.
+    pts: N_rays x N_samples x 3
+    frame_time: N_rays x 1
+    """
+    if occupancy_grid is None:
+        return network_query_fn(pts, viewdirs, frame_time, network_fn)
+
+    mask = occupancy_grid.query(pts, frame_time[:,None]) # N_rays x N_samples
+    position_delta = torch.zeros(list(mask.shape) + [3])
+    if not mask.any():
+        return torch.zeros(list(mask.shape) + [4]), position_delta
+
+    ray_indices, _ = pack_mask(mask)
+    raw_occ, position_delta_occ = network_query_fn(pts[mask], viewdirs, frame_time, network_fn, ray_indices=ray_indices)
+    raw = torch.zeros(list(mask.shape) + [raw_occ.shape[-1]])
+    raw[mask] = raw_occ
+    position_delta[mask] = position_delta_occ
+    return raw, position_delta
+
 def batchify_rays(rays_flat, chunk=1024*32, **kwargs):
     """Render rays in smaller minibatches to avoid OOM.
     """
@@ -146,7 +209,7 @@ def batchify_rays(rays_flat, chunk=1024*32, **kwargs):
 
 def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
                   near=0., far=1., frame_time=None,
-                  use_viewdirs=False, c2w_staticcam=None,
+                  use_viewdirs=False, c2w_staticcam=None, bounding_box=None,
                   **kwargs):
     """Render rays
     Args:
@@ -161,9 +224,14 @@ def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
       ndc: bool. If True, represent ray origin, direction in NDC coordinates.
       near: float or array of shape [batch_size]. Nearest distance for a ray.
       far: float or array of shape [batch_size]. Farthest distance for a ray.
+      frame_time: float or array of shape [batch_size]. Time of each ray, a
+       batch may mix times.
       use_viewdirs: bool. If True, use viewing direction of a point in space in model.
       c2w_staticcam: array of shape [3, 4]. If not None, use this transformation matrix for 
        camera while using other c2w argument for viewing directions.
+      bounding_box: (min, max) or None. If given (and not ndc), near/far of
+       every ray are clipped to its intersection with the box, rays that miss
+       the box are not rendered and return the background (zero outputs).
     Returns:
       rgb_map: [batch_size, 3]. Predicted RGB values for rays.
       disp_map: [batch_size]. Disparity map. Inverse of depth.
@@ -196,25 +264,60 @@ def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
     rays_d = torch.reshape(rays_d, [-1,3]).float()
 
     near, far = near * torch.ones_like(rays_d[...,:1]), far * torch.ones_like(rays_d[...,:1])
-    frame_time = frame_time * torch.ones_like(rays_d[...,:1])
+    frame_time = torch.reshape(torch.as_tensor(frame_time, dtype=torch.float32), [-1,1]) * torch.ones_like(rays_d[...,:1])
+
+    hit = None
+    if bounding_box is not None and not ndc:
+        # sample only the part of each ray inside the box
+        t_min, t_max = ray_box_intersection(rays_o, rays_d, *bounding_box)
+        near, far = torch.maximum(near, t_min), torch.minimum(far, t_max)
+        hit = (far > near)[:,0]
+        far = torch.maximum(far, near)
+
+    if kwargs.get('adaptive_sampling') is not None:
+        # one step schedule for all chunks, up to the farthest distance of any ray
+        s_max = (far[:,0] * torch.norm(rays_d, dim=-1)).max().item()
+        schedule = torch.from_numpy(adaptive_step_schedule(s_max, **kwargs['adaptive_sampling'])).to(rays_d)
+        kwargs = dict(kwargs, adaptive_sampling=dict(kwargs['adaptive_sampling'], schedule=schedule))
+
     rays = torch.cat([rays_o, rays_d, near, far, frame_time], -1)
     if use_viewdirs:
         rays = torch.cat([rays, viewdirs], -1)
 
     # Render and reshape
-    all_ret = batchify_rays(rays, chunk, **kwargs)
+    if hit is None:
+        all_ret = batchify_rays(rays, chunk, **kwargs)
+    else:
+        hit_idx = torch.nonzero(hit)[:,0]
+        any_hit = hit_idx.shape[0] > 0
+        # without any hit, a dummy ray gives the outputs and their shapes, its values are not used
+        hit_ret = batchify_rays(rays[hit_idx] if any_hit else rays[:1], chunk, **kwargs)
+        all_ret = {}
+        for k in hit_ret:
+            all_ret[k] = hit_ret[k].new_zeros([hit.shape[0]] + list(hit_ret[k].shape[1:]))
+            if k == 'rgb_map' and kwargs.get('white_bkgd', False):
+                all_ret[k] = all_ret[k] + 1.
+            if any_hit:
+                all_ret[k][hit_idx] = hit_ret[k]
+            elif hit_ret[k].requires_grad:
+                # keep the outputs in the graph, so that a loss on them can still backward
+                all_ret[k] = all_ret[k] + hit_ret[k][:0].sum()
     for k in all_ret:
         k_sh = list(sh[:-1]) + list(all_ret[k].shape[1:])
         all_ret[k] = torch.reshape(all_ret[k], k_sh)
 
     k_extract = ['rgb_map', 'disp_map', 'acc_map']
-    ret_list = [all_ret[k] for k in k_extract]
+    ret_list = [all_ret.get(k) for k in k_extract]
     ret_dict = {k : all_ret[k] for k in all_ret if k not in k_extract}
     return ret_list + [ret_dict]
 
 
-def render_path(render_poses, render_times, hwf, K, chunk, render_kwargs, gt_imgs=None, savedir=None,
-                render_factor=0, save_also_gt=False, i_offset=0):
+def render_path_iter(render_poses, render_times, hwf, K, chunk, render_kwargs, render_factor=0, batch_frames=1):
+    """Renders one image per pose and time and yields them as they are done.
+    batch_frames: number of frames whose rays are rendered together, so that
+      small images still fill the chunks. Their poses and times may differ.
+    Yields rgb [H, W, 3] and disp [H, W] (None if not rendered) as numpy arrays.
+    """
 
     H, W, focal = hwf
 
@@ -224,6 +327,32 @@ def render_path(render_poses, render_times, hwf, K, chunk, render_kwargs, gt_img
         W = W//render_factor
         focal = focal/render_factor
 
+    n_frames = min(len(render_poses), len(render_times))
+    for i0 in trange(0, n_frames, batch_frames):
+        # rays of all frames of the batch, with the time of their frame
+        poses = render_poses[i0:min(i0+batch_frames, n_frames)]
+        times = render_times[i0:min(i0+batch_frames, n_frames)]
+        rays_o, rays_d = zip(*[get_rays(H, W, K, c2w[:3,:4]) for c2w in poses])
+        frame_time = torch.cat([torch.ones(H*W, 1) * frame_time for frame_time in times])
+        rgb, disp, acc, _ = render(H, W, K, chunk=chunk, rays=(torch.stack(rays_o), torch.stack(rays_d)),
+                                   frame_time=frame_time, **render_kwargs)
+
+        for j in range(len(poses)):
+            yield rgb[j].cpu().numpy(), disp[j].cpu().numpy() if disp is not None else None
+
+
+def render_path(render_poses, render_times, hwf, K, chunk, render_kwargs, gt_imgs=None, savedir=None,
+                render_factor=0, save_also_gt=False, i_offset=0, batch_frames=1, video_prefix=None,
+                return_frames=True):
+    """Renders the path with render_path_iter. PNGs (savedir) and the videos
+    <video_prefix>rgb.mp4 / disp.mp4 are written in background threads while
+    the next frames render.
+    return_frames: if False, frames are not kept and (None, None) is returned,
+      host memory then does not depend on the number of frames.
+    The disparity video is normalized by the running maximum over the frames
+    so far, so its brightness does not change from frame to frame.
+    """
+
     if savedir is not None:
         save_dir_estim = os.path.join(savedir, "estim")
         save_dir_gt = os.path.join(savedir, "gt")
@@ -234,27 +363,115 @@ def render_path(render_poses, render_times, hwf, K, chunk, render_kwargs, gt_img
 
     rgbs = []
     disps = []
-
-    for i, (c2w, frame_time) in enumerate(zip(tqdm(render_poses), render_times)):
-        rgb, disp, acc, _ = render(H, W, K, chunk=chunk, c2w=c2w[:3,:4], frame_time=frame_time, **render_kwargs)
-        rgbs.append(rgb.cpu().numpy())
-        disps.append(disp.cpu().numpy())
-
-        if savedir is not None:
-            rgb8_estim = to8b(rgbs[-1])
-            filename = os.path.join(save_dir_estim, '{:03d}.png'.format(i+i_offset))
-            imageio.imwrite(filename, rgb8_estim)
-            if save_also_gt:
-                rgb8_gt = to8b(gt_imgs[i])
-                filename = os.path.join(save_dir_gt, '{:03d}.png'.format(i+i_offset))
-                imageio.imwrite(filename, rgb8_gt)
+    disp_max = 0.
+
+    with FrameWriter() as writer:
+        frames = render_path_iter(render_poses, render_times, hwf, K, chunk, render_kwargs,
+                                  render_factor=render_factor, batch_frames=batch_frames)
+        for i, (rgb, disp) in enumerate(frames):
+            if return_frames:
+                rgbs.append(rgb)
+                if disp is not None:
+                    disps.append(disp)
+
+            if savedir is not None:
+                filename = os.path.join(save_dir_estim, '{:03d}.png'.format(i+i_offset))
+                writer.write_png(filename, rgb)
+                if save_also_gt:
+                    filename = os.path.join(save_dir_gt, '{:03d}.png'.format(i+i_offset))
+                    writer.write_png(filename, gt_imgs[i])
+
+            if video_prefix is not None:
+                writer.append_video(video_prefix + 'rgb.mp4', rgb)
+                if disp is not None:
+                    disp_max = max(disp_max, float(np.max(disp)))
+                    writer.append_video(video_prefix + 'disp.mp4', disp / max(disp_max, 1e-10))
+
+    if not return_frames:
+        return None, None
 
     rgbs = np.stack(rgbs, 0)
-    disps = np.stack(disps, 0)
+    disps = np.stack(disps, 0) if len(disps) > 0 else None
 
     return rgbs, disps
 
 
+def render_progressive(H, W, K, c2w, frame_time, render_kwargs, time_budget, chunk=1024*32,
+                       preview_factor=4, tile=16):
+    """Renders the best image it can within time_budget seconds.
+    A preview at 1/preview_factor of the resolution and of the samples per
+    ray is upsampled first. The remaining time refines tiles of tile x tile
+    pixels at full quality, the tiles with the highest estimated error first
+    (variance of acc and color in the tile plus edges of acc).
+    Returns:
+      rgb_map: [H, W, 3].
+      acc_map: [H, W].
+      refined: [H, W] bool. Pixels rendered at full quality.
+    """
+    t_start = time.perf_counter()
+    sync = torch.cuda.synchronize if torch.cuda.is_available() else (lambda: None)
+    render_kwargs = dict(render_kwargs, render_outputs=['rgb', 'acc'])
+
+    # Preview
+    f = preview_factor
+    h, w = max(H//f, 1), max(W//f, 1)
+    K_low = np.array(K, dtype=np.float64)
+    K_low[:2] /= f
+    N_importance = render_kwargs.get('N_importance', 0)
+    preview_kwargs = dict(render_kwargs, N_samples=max(render_kwargs['N_samples']//f, 2),
+                          N_importance=max(N_importance//f, 1) if N_importance > 0 else 0)
+    rgb, _, acc, _ = render(h, w, K_low, chunk=chunk, c2w=c2w[:3,:4], frame_time=frame_time, **preview_kwargs)
+    sync()
+    # time per full-quality ray, from the preview. Clamped: fast passes can measure 0
+    min_ray_time = 1e-9
+    ray_time = max((time.perf_counter() - t_start) / (h*w) * f, min_ray_time)
+
+    up = lambda x: F.interpolate(x.permute(2,0,1)[None], size=(H, W), mode='bilinear', align_corners=False)[0].permute(1,2,0)
+    rgb = up(rgb)
+    acc = up(acc[...,None])[...,0]
+
+    # Estimated error per tile
+    nty, ntx = -(-H//tile), -(-W//tile)
+    def tiles(x): # H x W -> nty x ntx x tile*tile
+        x = F.pad(x, (0, ntx*tile-W, 0, nty*tile-H))
+        return x.view(nty, tile, ntx, tile).permute(0, 2, 1, 3).reshape(nty, ntx, -1)
+    edges = torch.zeros_like(acc)
+    edges[:,1:] += (acc[:,1:] - acc[:,:-1]).abs()
+    edges[1:,:] += (acc[1:,:] - acc[:-1,:]).abs()
+    score = tiles(acc).var(-1) + tiles(rgb.mean(-1)).var(-1) + tiles(edges).mean(-1)
+    order = torch.argsort(score.flatten(), descending=True).tolist()
+
+    # Refine the worst tiles while there is time
+    rays_o, rays_d = get_rays(H, W, K, c2w[:3,:4])
+    refined = torch.zeros(H, W, dtype=torch.bool)
+    tiles_per_batch = max(chunk // (tile*tile), 1)
+    b = 0
+    while b < len(order):
+        # as many tiles as fit into the remaining time
+        t_batch = time.perf_counter()
+        n_tiles = min(tiles_per_batch, int((time_budget - (t_batch - t_start)) / (ray_time * tile*tile)))
+        if n_tiles < 1:
+            break
+        ys, xs = [], []
+        for ty, tx in [divmod(i, ntx) for i in order[b:b+n_tiles]]:
+            y, x = torch.meshgrid(torch.arange(ty*tile, min((ty+1)*tile, H)),
+                                  torch.arange(tx*tile, min((tx+1)*tile, W)), indexing='ij')
+            ys.append(y.flatten())
+            xs.append(x.flatten())
+        ys, xs = torch.cat(ys), torch.cat(xs)
+        b += n_tiles
+
+        rgb_t, _, acc_t, _ = render(H, W, K, chunk=chunk, rays=(rays_o[ys, xs], rays_d[ys, xs]),
+                                    frame_time=frame_time, **render_kwargs)
+        rgb[ys, xs] = rgb_t
+        acc[ys, xs] = acc_t
+        refined[ys, xs] = True
+        sync()
+        ray_time = max((time.perf_counter() - t_batch) / len(ys), min_ray_time)
+
+    return rgb, acc, refined
+
+
 def create_nerf(args):
     """Instantiate NeRF's MLP model.
     """
@@ -279,6 +496,8 @@ def create_nerf(args):
     
     output_ch = 5 if args.N_importance > 0 else 4
     skips = [4]
+    checkpoint_stages = tuple(s for s in args.grad_checkpoint.split(',') if s)
+    assert all(s in ('encoder', 'mlp', 'composite') for s in checkpoint_stages), args.grad_checkpoint
     
     if args.i_embed==1:
         model = DirectTemporalNeRFSmall(num_layers=2,
@@ -289,11 +508,13 @@ def create_nerf(args):
                         input_ch=input_ch,
                         input_ch_views=input_ch_views,
                         input_ch_time=input_ch_time,
-                        embed_fn=embed_fn).to(device)
+                        embed_fn=embed_fn,
+                        checkpoint=checkpoint_stages).to(device)
     else:
         model = DirectTemporalNeRF(D=args.netdepth, W=args.netwidth,
                                    input_ch=input_ch, input_ch_views=input_ch_views, input_ch_time=input_ch_time,
-                                   output_ch=output_ch, skips=skips, use_viewdirs=args.use_viewdirs, embed_fn=embed_fn).to(device)
+                                   output_ch=output_ch, skips=skips, use_viewdirs=args.use_viewdirs, embed_fn=embed_fn,
+                                   checkpoint=checkpoint_stages).to(device)
     #grad_vars = []
     #for name, param in model.named_parameters():
     #    if "embed_fn" not in name:
@@ -305,7 +526,13 @@ def create_nerf(args):
     # if args.i_embed==1:
     #     args.N_importance = 0
 
-    if args.N_importance > 0:
+    if args.cone_angle > 0:
+        # adaptive sampling renders with one model and no importance samples
+        assert args.early_termination == 0., "--early_termination is not supported with --cone_angle > 0"
+        if args.N_importance > 0:
+            print('N_importance is not used with cone_angle > 0, no fine model')
+
+    if args.N_importance > 0 and not args.reuse_coarse_samples and args.cone_angle <= 0:
         if args.i_embed==1:
             model_fine = DirectTemporalNeRFSmall(num_layers=2,
                         hidden_dim=64,
@@ -315,21 +542,26 @@ def create_nerf(args):
                         input_ch=input_ch,
                         input_ch_views=input_ch_views,
                         input_ch_time=input_ch_time,
-                        embed_fn=embed_fn).to(device)
+                        embed_fn=embed_fn,
+                        checkpoint=checkpoint_stages).to(device)
         else:
             model_fine = DirectTemporalNeRF(D=args.netdepth_fine, W=args.netwidth_fine,
                                        input_ch=input_ch, input_ch_views=input_ch_views, input_ch_time=input_ch_time,
-                                       output_ch=output_ch, skips=skips, use_viewdirs=args.use_viewdirs, embed_fn=embed_fn).to(device)
+                                       output_ch=output_ch, skips=skips, use_viewdirs=args.use_viewdirs, embed_fn=embed_fn,
+                                       checkpoint=checkpoint_stages).to(device)
         #for name, param in model.named_parameters():
         #    if "embed_fn" not in name:
         #        grad_vars.append(param)
         grad_vars += list(model_fine.parameters())
 
-    network_query_fn = lambda inputs, viewdirs, ts, network_fn : run_network(inputs, viewdirs, ts, network_fn,
+    network_query_fn = lambda inputs, viewdirs, ts, network_fn, ray_indices=None : run_network(inputs, viewdirs, ts, network_fn,
                                                                 embed_fn=embed_fn,
                                                                 embeddirs_fn=embeddirs_fn,
                                                                 embedtime_fn=embedtime_fn,
-                                                                netchunk=args.netchunk)
+                                                                netchunk=args.netchunk,
+                                                                morton_box=args.bounding_box if args.morton_sort else None,
+                                                                ray_indices=ray_indices,
+                                                                checkpoint=checkpoint_stages)
     
     # Create optimizer
     if args.i_embed==1:
@@ -348,6 +580,11 @@ def create_nerf(args):
     else:
         optimizer = torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.999))
 
+    occupancy_grid = None
+    if args.occ_grid:
+        occupancy_grid = OccupancyGrid(args.bounding_box, resolution=args.occ_res,
+                                       n_time_buckets=args.occ_time_buckets, threshold=args.occ_threshold).to(device)
+
     start = 0
     basedir = args.basedir
     expname = args.expname
@@ -375,6 +612,8 @@ def create_nerf(args):
             model_fine.load_state_dict(ckpt['network_fine_state_dict'])
         if args.i_embed==1:
             embed_fn.load_state_dict(ckpt['embed_fn_state_dict'])
+        if occupancy_grid is not None and ckpt.get('occupancy_grid_state_dict') is not None:
+            occupancy_grid.load_state_dict(ckpt['occupancy_grid_state_dict'])
 
     ##########################
     # pdb.set_trace()
@@ -390,7 +629,21 @@ def create_nerf(args):
         'use_viewdirs' : args.use_viewdirs,
         'white_bkgd' : args.white_bkgd,
         'raw_noise_std' : args.raw_noise_std,
+        'occupancy_grid' : occupancy_grid,
+        'bounding_box' : args.bounding_box if args.ray_box_near_far else None,
+        'reuse_coarse' : args.reuse_coarse_samples,
+        'adaptive_sampling' : None,
+        'fused_compositing' : args.fused_compositing,
+        'checkpoint' : checkpoint_stages,
+        'stratified_importance' : args.stratified_importance,
     }
+    if args.cone_angle > 0:
+        # smallest step: one voxel of the finest hash grid level
+        box_min, box_max = [torch.as_tensor(v).float() for v in args.bounding_box]
+        min_step = ((box_max - box_min) / args.finest_res).min().item()
+        render_kwargs_train['adaptive_sampling'] = {'min_step': min_step,
+                                                    'max_step': min_step * args.max_step_voxels,
+                                                    'cone_angle': args.cone_angle}
 
     # NDC only good for LLFF-style forward facing data
     if args.dataset_type != 'llff' or args.no_ndc:
@@ -401,16 +654,84 @@ def create_nerf(args):
     render_kwargs_test = {k : render_kwargs_train[k] for k in render_kwargs_train}
     render_kwargs_test['perturb'] = False
     render_kwargs_test['raw_noise_std'] = 0.
+    render_kwargs_test['early_termination'] = args.early_termination
+    render_kwargs_test['march_batch'] = args.march_batch
+    render_outputs = [s for s in args.render_outputs.split(',') if s]
+    unknown = [s for s in render_outputs if s not in ('rgb', 'disp', 'acc', 'depth', 'sparsity')]
+    assert not unknown, f"--render_outputs: unknown outputs {unknown}, expected any of rgb,disp,acc,depth,sparsity"
+    # render_path always needs rgb
+    render_kwargs_test['render_outputs'] = ['rgb'] + [s for s in render_outputs if s != 'rgb']
 
     return render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer
 
 
-def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=False):
+class VolumeRendering(torch.autograd.Function):
+    '''
+    Compositing of raw2outputs with a custom backward. Only raw, dists and
+    z_vals are saved; alpha, the transmittance and the weights are recomputed
+    in the backward instead of keeping them and the broadcast products of
+    every sample for autograd.
+    raw: [N_rays, N_samples, 4], sigma (raw[...,3]) including the noise
+    dists: [N_rays, N_samples], scaled by |rays_d|; z_vals: [N_rays, N_samples]
+      dists and z_vals get no gradient.
+    returns rgb_map [N_rays, 3], depth_map [N_rays], acc_map [N_rays],
+    weights [N_rays, N_samples], as raw2outputs (without the background)
+    '''
+    @staticmethod
+    def composite(raw, dists):
+        alpha = 1.-torch.exp(-F.relu(raw[...,3])*dists)
+        trans = torch.cumprod(torch.cat([torch.ones_like(alpha[:,:1]), 1.-alpha + 1e-10], -1), -1)[:, :-1]
+        return alpha, trans, torch.sigmoid(raw[...,:3])
+
+    @staticmethod
+    def forward(ctx, raw, dists, z_vals):
+        alpha, trans, rgb = VolumeRendering.composite(raw, dists)
+        weights = alpha * trans
+        rgb_map = torch.sum(weights[...,None] * rgb, -2)
+        depth_map = torch.sum(weights * z_vals, -1)
+        acc_map = torch.sum(weights, -1)
+        ctx.save_for_backward(raw, dists, z_vals)
+        return rgb_map, depth_map, acc_map, weights
+
+    @staticmethod
+    def backward(ctx, grad_rgb_map, grad_depth_map, grad_acc_map, grad_weights):
+        raw, dists, z_vals = ctx.saved_tensors
+        alpha, trans, rgb = VolumeRendering.composite(raw, dists)
+        weights = alpha * trans
+
+        # every output is sum_i w_i * g_i for a per-sample g_i
+        g = torch.zeros_like(weights) if grad_weights is None else grad_weights.clone()
+        if grad_rgb_map is not None:
+            g += torch.sum(grad_rgb_map[:,None,:] * rgb, -1)
+        if grad_depth_map is not None:
+            g += grad_depth_map[:,None] * z_vals
+        if grad_acc_map is not None:
+            g += grad_acc_map[:,None]
+
+        # d/d alpha_k: g_k T_k - sum_{i>k} g_i w_i / (1 - alpha_k + 1e-10)
+        gw = g * weights
+        behind = torch.sum(gw, -1, keepdim=True) - torch.cumsum(gw, -1)
+        grad_alpha = g * trans - behind / (1.-alpha + 1e-10)
+        grad_sigma = grad_alpha * (1.-alpha) * dists * (raw[...,3] > 0)
+
+        if grad_rgb_map is not None:
+            grad_rgb = weights[...,None] * grad_rgb_map[:,None,:] * rgb * (1.-rgb)
+        else:
+            grad_rgb = torch.zeros_like(rgb)
+        return torch.cat([grad_rgb, grad_sigma[...,None]], -1), None, None
+
+
+def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=False, outputs=None, fused=False):
     """Transforms model's predictions to semantically meaningful values.
     Args:
         raw: [num_rays, num_samples along ray, 4]. Prediction from model.
         z_vals: [num_rays, num_samples along ray]. Integration time.
         rays_d: [num_rays, 3]. Direction of each ray.
+        outputs: None for all outputs, or a collection of 'rgb', 'disp', 'acc',
+          'depth' and 'sparsity'. The others are not computed and returned
+          as None, weights are always returned.
+        fused: composite with VolumeRendering, which recomputes the per-sample
+          intermediates in the backward instead of storing them.
     Returns:
         rgb_map: [num_rays, 3]. Estimated RGB color of a ray.
         disp_map: [num_rays]. Disparity map. Inverse of depth map.
@@ -419,13 +740,13 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
         depth_map: [num_rays]. Estimated distance to object.
     """
     raw2alpha = lambda raw, dists, act_fn=F.relu: 1.-torch.exp(-act_fn(raw)*dists)
+    want = lambda k: outputs is None or k in outputs
 
     dists = z_vals[...,1:] - z_vals[...,:-1]
-    dists = torch.cat([dists, torch.Tensor([1e10]).expand(dists[...,:1].shape)], -1)  # [N_rays, N_samples]
+    dists = F.pad(dists, (0, 1), value=1e10)  # [N_rays, N_samples]
 
     dists = dists * torch.norm(rays_d[...,None,:], dim=-1)
 
-    rgb = torch.sigmoid(raw[...,:3])  # [N_rays, N_samples, 3]
     noise = 0.
     if raw_noise_std > 0.:
         noise = torch.randn(raw[...,3].shape) * raw_noise_std
@@ -436,11 +757,163 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
             noise = np.random.rand(*list(raw[...,3].shape)) * raw_noise_std
             noise = torch.Tensor(noise)
 
-    # sigma_loss = sigma_sparsity_loss(raw[...,3])
-    alpha = raw2alpha(raw[...,3] + noise, dists)  # [N_rays, N_samples]
-    # weights = alpha * tf.math.cumprod(1.-alpha + 1e-10, -1, exclusive=True)
-    weights = alpha * torch.cumprod(torch.cat([torch.ones((alpha.shape[0], 1)), 1.-alpha + 1e-10], -1), -1)[:, :-1]
-    rgb_map = torch.sum(weights[...,None] * rgb, -2)  # [N_rays, 3]
+    if fused:
+        if raw_noise_std > 0.:
+            raw = torch.cat([raw[...,:3], (raw[...,3] + noise)[...,None]], -1)
+        rgb_map, depth_map, acc_map, weights = VolumeRendering.apply(raw, dists, z_vals)
+        disp_map, sparsity_loss = None, None
+        if not want('rgb'):
+            rgb_map = None
+        elif white_bkgd:
+            rgb_map = rgb_map + (1.-acc_map[...,None])
+
+    else:
+        # sigma_loss = sigma_sparsity_loss(raw[...,3])
+        alpha = raw2alpha(raw[...,3] + noise, dists)  # [N_rays, N_samples]
+        # weights = alpha * tf.math.cumprod(1.-alpha + 1e-10, -1, exclusive=True)
+        weights = alpha * torch.cumprod(torch.cat([torch.ones((alpha.shape[0], 1)), 1.-alpha + 1e-10], -1), -1)[:, :-1]
+
+        rgb_map, disp_map, acc_map, depth_map, sparsity_loss = None, None, None, None, None
+        if want('acc') or want('disp') or want('sparsity') or (want('rgb') and white_bkgd):
+            acc_map = torch.sum(weights, -1)
+
+        if want('rgb'):
+            rgb = torch.sigmoid(raw[...,:3])  # [N_rays, N_samples, 3]
+            rgb_map = torch.sum(weights[...,None] * rgb, -2)  # [N_rays, 3]
+            if white_bkgd:
+                rgb_map = rgb_map + (1.-acc_map[...,None])
+
+        if want('depth') or want('disp'):
+            depth_map = torch.sum(weights * z_vals, -1)
+    if want('disp'):
+        disp_map = 1./torch.max(1e-10 * torch.ones_like(depth_map), depth_map / acc_map)
+
+    if want('sparsity'):
+        # Calculate weights sparsity loss
+        mask = acc_map > 0.5
+        entropy = Categorical(probs = weights+1e-5).entropy()
+        sparsity_loss = entropy * mask
+
+    return rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss
+
+
+def raw2outputs_packed(raw, z_vals, rays_d, ray_indices, offsets, raw_noise_std=0, white_bkgd=False, dists=None):
+    """raw2outputs for packed samples (see pack_counts()), the number of
+    samples may differ from ray to ray.
+    Args:
+        raw: [N, 4]. Prediction from model.
+        z_vals: [N]. Integration time, increasing within every ray.
+        rays_d: [num_rays, 3]. Direction of each ray.
+        ray_indices, offsets: packing of the samples into the rays.
+        dists: [N] or None. Length of the interval of every sample, in the
+          units of z_vals. By default the distance to the next sample of the
+          ray (1e10 for the last one).
+    Returns:
+        rgb_map, disp_map, acc_map, depth_map, sparsity_loss: [num_rays, ...] as in raw2outputs.
+        weights: [N]. Weights assigned to each sample.
+    """
+    n_rays = offsets.shape[0] - 1
+    last = offsets[1:][offsets[1:] > offsets[:-1]] - 1 # last sample of every non-empty ray
+
+    if dists is None:
+        dists = torch.cat([z_vals[1:] - z_vals[:-1], torch.Tensor([1e10])])
+        dists = dists.index_fill(0, last, 1e10)
+    dists = dists * torch.norm(rays_d, dim=-1)[ray_indices]
+
+    rgb = torch.sigmoid(raw[...,:3])  # [N, 3]
+    noise = 0.
+    if raw_noise_std > 0.:
+        noise = torch.randn(raw[...,3].shape) * raw_noise_std
+
+    alpha = 1.-torch.exp(-F.relu(raw[...,3] + noise)*dists)  # [N]
+    # exclusive cumprod of 1-alpha within every ray, as a cumsum of logs
+    transmittance = torch.exp(segment_cumsum(torch.log(1.-alpha + 1e-10), ray_indices, offsets, exclusive=True))
+    weights = alpha * transmittance
+    rgb_map = segment_sum(weights[...,None] * rgb, ray_indices, n_rays)  # [N_rays, 3]
+
+    depth_map = segment_sum(weights * z_vals, ray_indices, n_rays)
+    acc_map = segment_sum(weights, ray_indices, n_rays)
+    disp_map = 1./torch.max(1e-10 * torch.ones_like(depth_map), depth_map / acc_map)
+
+    if white_bkgd:
+        rgb_map = rgb_map + (1.-acc_map[...,None])
+
+    # Calculate weights sparsity loss: entropy of the normalized weights+1e-5
+    p = weights + 1e-5
+    p = p / segment_sum(p, ray_indices, n_rays)[ray_indices]
+    entropy = segment_sum(-p * torch.log(p), ray_indices, n_rays)
+    sparsity_loss = entropy * (acc_map > 0.5)
+
+    return rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss
+
+
+def sample_along_rays(near, far, N_samples, lindisp=False, perturb=0., pytest=False):
+    """Depths of N_samples samples per ray between near and far.
+    near, far: [N_rays, 1]
+    Returns z_vals: [N_rays, N_samples]
+    """
+    t_vals = torch.linspace(0., 1., steps=N_samples)
+    if not lindisp:
+        z_vals = near * (1.-t_vals) + far * (t_vals)
+    else:
+        z_vals = 1./(1./near * (1.-t_vals) + 1./far * (t_vals))
+
+    z_vals = z_vals.expand([near.shape[0], N_samples])
+
+    if perturb > 0.:
+        # get intervals between samples
+        mids = .5 * (z_vals[...,1:] + z_vals[...,:-1])
+        upper = torch.cat([mids, z_vals[...,-1:]], -1)
+        lower = torch.cat([z_vals[...,:1], mids], -1)
+        # stratified samples in those intervals
+        t_rand = torch.rand(z_vals.shape)
+
+        # Pytest, overwrite u with numpy's fixed random numbers
+        if pytest:
+            np.random.seed(0)
+            t_rand = np.random.rand(*list(z_vals.shape))
+            t_rand = torch.Tensor(t_rand)
+
+        z_vals = lower + (upper - lower) * t_rand
+    return z_vals
+
+
+def march_rays(network_query_fn, network_fn, rays_o, rays_d, viewdirs, frame_time, z_vals,
+               white_bkgd=False, threshold=1e-4, march_batch=16, occupancy_grid=None):
+    """Inference compositing with early ray termination. Marches all rays in
+    steps of march_batch samples and composites each step into the running
+    color. A ray leaves the active set once its transmittance drops below
+    threshold. The active rays are kept as an index tensor, so the network
+    only sees samples of live rays. Same outputs as raw2outputs (without
+    noise) for the samples that were evaluated.
+    z_vals: [N_rays, N_samples]
+    Returns rgb_map, disp_map, acc_map, weights, depth_map like raw2outputs.
+    """
+    dists = z_vals[...,1:] - z_vals[...,:-1]
+    dists = torch.cat([dists, torch.Tensor([1e10]).expand(dists[...,:1].shape)], -1)  # [N_rays, N_samples]
+    dists = dists * torch.norm(rays_d[...,None,:], dim=-1)
+
+    weights = torch.zeros_like(z_vals)
+    rgb_map = torch.zeros_like(rays_o)
+    transmittance = torch.ones_like(z_vals[:,0])
+    active = torch.arange(z_vals.shape[0], device=z_vals.device)
+    for s in range(0, z_vals.shape[-1], march_batch):
+        z = z_vals[active, s:s+march_batch]
+        pts = rays_o[active,None,:] + rays_d[active,None,:] * z[...,:,None] # [N_active, march_batch, 3]
+        raw, _ = query_occupied(network_query_fn, pts, viewdirs[active] if viewdirs is not None else None,
+                                frame_time[active], network_fn, occupancy_grid)
+
+        alpha = 1.-torch.exp(-F.relu(raw[...,3])*dists[active, s:s+march_batch])
+        trans = torch.cumprod(1.-alpha + 1e-10, -1)
+        w = alpha * transmittance[active,None] * torch.cat([torch.ones_like(trans[:,:1]), trans[:,:-1]], -1)
+        weights[active, s:s+march_batch] = w
+        rgb_map[active] += torch.sum(w[...,None] * torch.sigmoid(raw[...,:3]), -2)
+        transmittance[active] = transmittance[active] * trans[:,-1]
+
+        # compact: keep only the rays that can still change
+        active = active[transmittance[active] > threshold]
+        if len(active) == 0:
+            break
 
     depth_map = torch.sum(weights * z_vals, -1)
     disp_map = 1./torch.max(1e-10 * torch.ones_like(depth_map), depth_map / torch.sum(weights, -1))
@@ -449,12 +922,85 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
     if white_bkgd:
         rgb_map = rgb_map + (1.-acc_map[...,None])
 
-    # Calculate weights sparsity loss
-    mask = weights.sum(-1) > 0.5
-    entropy = Categorical(probs = weights+1e-5).entropy()
-    sparsity_loss = entropy * mask
+    return rgb_map, disp_map, acc_map, weights, depth_map
 
-    return rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss
+
+def adaptive_step_schedule(s_max, min_step, max_step, cone_angle):
+    """Distances 0 = s_0 < s_1 < ... >= s_max along a ray with the step
+    s_{k+1} - s_k = clip(s_k * cone_angle, min_step, max_step): fine steps
+    close to the camera, growing with the distance like a cone.
+    Returns s: [M+1] on the host (numpy).
+    """
+    # min_step up to s = min_step / cone_angle: s_k = k * min_step
+    n_const = int(np.floor(1. / cone_angle)) + 1
+    s = min_step * np.arange(n_const + 1, dtype=np.float64)
+    # then s_{k+1} = s_k * (1 + cone_angle) up to s = max_step / cone_angle
+    s_cone = max_step / cone_angle
+    if s[-1] < s_cone and s[-1] < s_max:
+        n_geo = int(np.ceil(np.log(min(s_cone, s_max) / s[-1]) / np.log1p(cone_angle)))
+        s = np.concatenate([s, s[-1] * np.power(1. + cone_angle, np.arange(1, n_geo + 1))])
+    # then max_step
+    if s[-1] < s_max:
+        n_max = int(np.ceil((s_max - s[-1]) / max_step))
+        s = np.concatenate([s, s[-1] + max_step * np.arange(1, n_max + 1)])
+    # up to the first distance >= s_max
+    return s[:np.searchsorted(s, s_max) + 1].astype(np.float32)
+
+
+def render_rays_adaptive(rays_o, rays_d, viewdirs, near, far, frame_time, network_fn, network_query_fn,
+                         adaptive_sampling, perturb=0., white_bkgd=False, raw_noise_std=0., occupancy_grid=None,
+                         render_outputs=None):
+    """Volume rendering with adaptive step sizes instead of N_samples per ray.
+    All rays share one schedule of world-space distances from the camera
+    (see adaptive_step_schedule), each ray takes the steps between its near
+    and far. Samples in empty cells of the occupancy grid are dropped. The
+    remaining samples are packed (see pack_counts()) and composited with
+    the length of their own step, so dropped samples do not stretch the
+    intervals of their neighbours.
+    adaptive_sampling: dict with min_step, max_step (world units), cone_angle
+      and schedule, the output of adaptive_step_schedule() as a tensor (set
+      by render()). The schedule must reach the farthest distance of the rays.
+    render_outputs: None or collection of outputs as in render_rays().
+    Returns rgb_map, disp_map, acc_map, sparsity_loss and n_samples per ray.
+    """
+    N_rays = rays_o.shape[0]
+    ray_norm = torch.norm(rays_d, dim=-1, keepdim=True) # [N_rays, 1]
+    near_s, far_s = near * ray_norm, far * ray_norm
+
+    s = adaptive_sampling['schedule']
+    ds = s[1:] - s[:-1]
+    first = torch.searchsorted(s[:-1], near_s.contiguous())[:,0]
+    last = torch.searchsorted(s[:-1], far_s.contiguous())[:,0]
+    ray_indices, offsets = pack_counts(last - first)
+    step = first[ray_indices] + torch.arange(len(ray_indices), device=offsets.device) - offsets[ray_indices]
+
+    # stratified position inside each step
+    t_rand = torch.rand(step.shape) if perturb > 0. else 0.5
+    z_vals = (s[step] + t_rand * ds[step]) / ray_norm[ray_indices,0]
+    dists = ds[step] / ray_norm[ray_indices,0]
+    pts = rays_o[ray_indices] + rays_d[ray_indices] * z_vals[:,None]
+
+    if occupancy_grid is not None:
+        keep = occupancy_grid.query(pts, frame_time[ray_indices])
+        ray_indices, z_vals, dists, pts = ray_indices[keep], z_vals[keep], dists[keep], pts[keep]
+        offsets = torch.cat([offsets.new_zeros(1), torch.cumsum(torch.bincount(ray_indices, minlength=N_rays), 0)])
+
+    if len(pts) > 0:
+        raw, _ = network_query_fn(pts, viewdirs, frame_time, network_fn, ray_indices=ray_indices)
+    else:
+        raw = torch.zeros(0, 4)
+    rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss = raw2outputs_packed(
+        raw, z_vals, rays_d, ray_indices, offsets, raw_noise_std, white_bkgd, dists=dists)
+
+    ret = {'rgb_map' : rgb_map, 'disp_map' : disp_map, 'acc_map' : acc_map, 'sparsity_loss' : sparsity_loss,
+           'n_samples' : (offsets[1:] - offsets[:-1]).float()}
+    if render_outputs is not None:
+        # all outputs come out of raw2outputs_packed, keep only the ones asked for
+        names = {'rgb_map' : 'rgb', 'disp_map' : 'disp', 'acc_map' : 'acc', 'sparsity_loss' : 'sparsity'}
+        ret = {k : ret[k] for k in ret if names.get(k) is None or names[k] in render_outputs}
+        if 'depth' in render_outputs:
+            ret['depth_map'] = depth_map
+    return ret
 
 
 def render_rays(ray_batch,
@@ -472,7 +1018,16 @@ def render_rays(ray_batch,
                 verbose=False,
                 pytest=False,
                 z_vals=None,
-                use_two_models_for_fine=False):
+                use_two_models_for_fine=False,
+                occupancy_grid=None,
+                early_termination=0.,
+                march_batch=16,
+                render_outputs=None,
+                reuse_coarse=False,
+                adaptive_sampling=None,
+                fused_compositing=False,
+                checkpoint=(),
+                stratified_importance=False):
     """Volumetric rendering.
     Args:
       ray_batch: array of shape [batch_size, ...]. All information necessary
@@ -492,6 +1047,29 @@ def render_rays(ray_batch,
       white_bkgd: bool. If True, assume a white background.
       raw_noise_std: ...
       verbose: bool. If True, print more debugging info.
+      occupancy_grid: OccupancyGrid or None. If given, samples in empty cells
+        are not passed to the network.
+      early_termination: float. If > 0, render with march_rays() and stop
+        rays whose transmittance falls below this value (inference only:
+        returns rgb_map, disp_map, acc_map and z_vals only).
+      march_batch: int. Samples per ray and marching step for early_termination.
+      render_outputs: None or collection of raw2outputs outputs to compute,
+        e.g. ('rgb',) or ('rgb', 'disp', 'acc'). Outputs not listed (and the
+        sparsity losses) are left out of the returned dict.
+      reuse_coarse: bool. If True (network_fine must be None), the fine pass
+        only evaluates the N_importance new samples and reuses the coarse
+        outputs for the N_samples coarse ones.
+      adaptive_sampling: dict or None. If given, render with
+        render_rays_adaptive() instead of N_samples/N_importance (network_fn
+        only, early_termination must be 0). render() adds the step schedule.
+      fused_compositing: bool. Use raw2outputs(fused=True), which saves
+        activation memory in the backward.
+      checkpoint: tuple of stages. With 'composite', the activations of
+        raw2outputs are recomputed in the backward. The network stages are set
+        in network_query_fn.
+      stratified_importance: bool. If True and perturb > 0, the N_importance
+        samples are drawn from sample_pdf(stratified=True) (one jittered u per
+        equal-mass bin) instead of independent uniform u.
     Returns:
       rgb_map: [num_rays, 3]. Estimated RGB color of a ray. Comes from fine model.
       disp_map: [num_rays]. Disparity map. 1 / depth.
@@ -511,64 +1089,85 @@ def render_rays(ray_batch,
     near, far, frame_time = bounds[...,0], bounds[...,1], bounds[...,2] # [-1,1]
     z_samples = None
     rgb_map_0, disp_map_0, acc_map_0, position_delta_0 = None, None, None, None
+    composite = checkpointed(raw2outputs, 'composite' in checkpoint)
+
+    if adaptive_sampling is not None:
+        assert early_termination == 0., "early_termination is not supported with adaptive_sampling"
+        return render_rays_adaptive(rays_o, rays_d, viewdirs, near, far, frame_time, network_fn, network_query_fn,
+                                    adaptive_sampling, perturb=perturb, white_bkgd=white_bkgd,
+                                    raw_noise_std=raw_noise_std, occupancy_grid=occupancy_grid,
+                                    render_outputs=render_outputs)
+
+    if early_termination > 0.:
+        march_kwargs = dict(white_bkgd=white_bkgd, threshold=early_termination, march_batch=march_batch,
+                            occupancy_grid=occupancy_grid)
+        if z_vals is None:
+            z_vals = sample_along_rays(near, far, N_samples, lindisp, perturb, pytest=pytest)
+            if N_importance > 0:
+                _, _, _, weights, _ = march_rays(network_query_fn, network_fn, rays_o, rays_d, viewdirs, frame_time,
+                                                 z_vals, **march_kwargs)
+                z_vals_mid = .5 * (z_vals[...,1:] + z_vals[...,:-1])
+                z_samples = sample_pdf(z_vals_mid, weights[...,1:-1], N_importance, det=(perturb==0.), pytest=pytest,
+                                       stratified=stratified_importance and perturb > 0.)
+                z_vals, _ = torch.sort(torch.cat([z_vals, z_samples], -1), -1)
+        run_fn = network_fn if network_fine is None else network_fine
+        rgb_map, disp_map, acc_map, _, _ = march_rays(network_query_fn, run_fn, rays_o, rays_d, viewdirs, frame_time,
+                                                      z_vals, **march_kwargs)
+        return {'rgb_map' : rgb_map, 'disp_map' : disp_map, 'acc_map' : acc_map, 'z_vals' : z_vals}
 
     #why
     if z_vals is None:
-        t_vals = torch.linspace(0., 1., steps=N_samples)
-        if not lindisp:
-            z_vals = near * (1.-t_vals) + far * (t_vals)
-        else:
-            z_vals = 1./(1./near * (1.-t_vals) + 1./far * (t_vals))
-
-        z_vals = z_vals.expand([N_rays, N_samples])
-
-        if perturb > 0.:
-            # get intervals between samples
-            mids = .5 * (z_vals[...,1:] + z_vals[...,:-1])
-            upper = torch.cat([mids, z_vals[...,-1:]], -1)
-            lower = torch.cat([z_vals[...,:1], mids], -1)
-            # stratified samples in those intervals
-            t_rand = torch.rand(z_vals.shape)
-
-            # Pytest, overwrite u with numpy's fixed random numbers
-            if pytest:
-                np.random.seed(0)
-                t_rand = np.random.rand(*list(z_vals.shape))
-                t_rand = torch.Tensor(t_rand)
-
-            z_vals = lower + (upper - lower) * t_rand
+        z_vals = sample_along_rays(near, far, N_samples, lindisp, perturb, pytest=pytest)
 
         pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None] # [N_rays, N_samples, 3]
 
         if N_importance <= 0:
-            raw, position_delta = network_query_fn(pts, viewdirs, frame_time, network_fn)
-            rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest)
+            raw, position_delta = query_occupied(network_query_fn, pts, viewdirs, frame_time, network_fn, occupancy_grid)
+            rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss = composite(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, outputs=render_outputs, fused=fused_compositing)
 
         else:
             if use_two_models_for_fine:
-                raw, position_delta_0 = network_query_fn(pts, viewdirs, frame_time, network_fn)
-                rgb_map_0, disp_map_0, acc_map_0, weights, _, sparsity_loss_0 = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest)
+                raw, position_delta_0 = query_occupied(network_query_fn, pts, viewdirs, frame_time, network_fn, occupancy_grid)
+                rgb_map_0, disp_map_0, acc_map_0, weights, _, sparsity_loss_0 = composite(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, outputs=render_outputs, fused=fused_compositing)
 
             else:
-                with torch.no_grad():
-                    raw, _ = network_query_fn(pts, viewdirs, frame_time, network_fn)
-                    _, _, _, weights, _, sparsity_loss_0 = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest)
+                # reused coarse outputs are part of the fine pass and keep their gradient
+                with torch.set_grad_enabled(torch.is_grad_enabled() and reuse_coarse):
+                    raw, position_delta = query_occupied(network_query_fn, pts, viewdirs, frame_time, network_fn, occupancy_grid)
+                    # only the weights are needed. No gradient flows through this pass,
+                    # so its sparsity loss would only be a constant in the training loss
+                    _, _, _, weights, _, _ = composite(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, outputs=(), fused=fused_compositing)
+                    sparsity_loss_0 = torch.zeros_like(weights[:,0]) if render_outputs is None else None
 
             z_vals_mid = .5 * (z_vals[...,1:] + z_vals[...,:-1])
-            z_samples = sample_pdf(z_vals_mid, weights[...,1:-1], N_importance, det=(perturb==0.), pytest=pytest)
+            z_samples = sample_pdf(z_vals_mid, weights[...,1:-1], N_importance, det=(perturb==0.), pytest=pytest,
+                                   stratified=stratified_importance and perturb > 0.)
             z_samples = z_samples.detach()
-            z_vals, _ = torch.sort(torch.cat([z_vals, z_samples], -1), -1)
+            raw_0, position_delta_cached = raw, (position_delta_0 if use_two_models_for_fine else position_delta)
+            z_vals, order = torch.sort(torch.cat([z_vals, z_samples], -1), -1)
 
-    pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None] # [N_rays, N_samples + N_importance, 3]
     run_fn = network_fn if network_fine is None else network_fine
-    raw, position_delta = network_query_fn(pts, viewdirs, frame_time, run_fn)
-    rgb_map, disp_map, acc_map, weights, _, sparsity_loss = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest)
+    if reuse_coarse and z_samples is not None:
+        # evaluate the importance samples only, then merge with the coarse outputs in depth order
+        assert network_fine is None, "reuse_coarse needs the same model for the coarse and fine pass"
+        pts = rays_o[...,None,:] + rays_d[...,None,:] * z_samples[...,:,None] # [N_rays, N_importance, 3]
+        raw, position_delta = query_occupied(network_query_fn, pts, viewdirs, frame_time, run_fn, occupancy_grid)
+        raw = torch.gather(torch.cat([raw_0, raw], -2), -2, order[...,None].expand(-1, -1, raw.shape[-1]))
+        position_delta = torch.gather(torch.cat([position_delta_cached, position_delta], -2), -2,
+                                      order[...,None].expand(-1, -1, position_delta.shape[-1]))
+    else:
+        pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None] # [N_rays, N_samples + N_importance, 3]
+        raw, position_delta = query_occupied(network_query_fn, pts, viewdirs, frame_time, run_fn, occupancy_grid)
+    rgb_map, disp_map, acc_map, weights, depth_map, sparsity_loss = composite(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, outputs=render_outputs, fused=fused_compositing)
 
     ret = {'rgb_map' : rgb_map, 'disp_map' : disp_map, 'acc_map' : acc_map, 'z_vals' : z_vals, 'sparsity_loss' : sparsity_loss, 'position_delta':position_delta}
+    if render_outputs is not None and 'depth' in render_outputs:
+        ret['depth_map'] = depth_map
     if retraw:
         ret['raw'] = raw
     if N_importance > 0:
-        ret['sparsity_loss0'] = sparsity_loss_0
+        if sparsity_loss_0 is not None:
+            ret['sparsity_loss0'] = sparsity_loss_0
         if rgb_map_0 is not None:
             ret['rgb0'] = rgb_map_0
         if disp_map_0 is not None:
@@ -579,9 +1178,11 @@ def render_rays(ray_batch,
             ret['position_delta_0'] = position_delta_0
         if z_samples is not None:
             ret['z_std'] = torch.std(z_samples, dim=-1, unbiased=False)  # [N_rays]
+    # outputs left out by render_outputs
+    ret = {k : ret[k] for k in ret if ret[k] is not None}
 
     for k in ret:
-        if (torch.isnan(ret[k]).any() or torch.isinf(ret[k]).any()) and DEBUG:
+        if DEBUG and (torch.isnan(ret[k]).any() or torch.isinf(ret[k]).any()):
             print(f"! [Numerical Error] {k} contains nan or inf.")
 
     return ret
@@ -619,8 +1220,10 @@ def config_parser():
                         help='number of rays processed in parallel, decrease if running out of memory')
     parser.add_argument("--netchunk", type=int, default=1024*64, 
                         help='number of pts sent through network in parallel, decrease if running out of memory')
+    parser.add_argument("--n_images_per_batch", type=int, default=1,
+                        help='with no_batching, number of images (and times) the rays of a step are drawn from')
     parser.add_argument("--no_batching", action='store_true', 
-                        help='only take random rays from 1 image at a time')
+                        help='only take random rays from n_images_per_batch images at a time')
     parser.add_argument("--no_reload", action='store_true', 
                         help='do not reload weights from saved ckpt')
     parser.add_argument("--ft_path", type=str, default=None, 
@@ -633,6 +1236,8 @@ def config_parser():
                         help='number of additional fine samples per ray')
     parser.add_argument("--perturb", type=float, default=1.,
                         help='set to 0. for no jitter, 1. for jitter')
+    parser.add_argument("--stratified_importance", action='store_true',
+                        help='draw the importance samples with stratified instead of independent uniform u (needs perturb > 0)')
     parser.add_argument("--use_viewdirs", action='store_true', 
                         help='use full 5D input instead of 3D')
     parser.add_argument("--i_embed", type=int, default=1, 
@@ -705,10 +1310,62 @@ def config_parser():
                         help='finest resolultion for hashed embedding')
     parser.add_argument("--log2_hashmap_size",   type=int, default=19, 
                         help='log2 of hashmap size')
+    parser.add_argument("--hash_fused_backward", action='store_true',
+                        help='hashed embedding backward recomputes interpolation weights instead of storing them, saves activation memory')
+    parser.add_argument("--hash_dtype", type=str, default='float32', choices=['float32', 'bfloat16'],
+                        help='storage dtype of the hash table (and its checkpoints), updates use an fp32 master copy that is not saved. No float16: its gradients would need loss scaling')
+    parser.add_argument("--hash_dedup", action='store_true',
+                        help='gather each distinct hash table row once per batch, see scripts/benchmark_hash_dedup.py')
+    parser.add_argument("--hash_levels_start", type=int, default=0,
+                        help='coarse-to-fine: number of hash levels active at the start of training, 0 to use all levels from the start')
+    parser.add_argument("--hash_levels_every", type=int, default=500,
+                        help='coarse-to-fine: switch on one more hash level every N iterations')
+    parser.add_argument("--hash_stats_every", type=int, default=0,
+                        help='print hash table occupancy, collision and gradient stats every N iterations, 0 to disable')
+    parser.add_argument("--morton_sort", action='store_true',
+                        help='query the network on samples sorted in Morton order, see scripts/benchmark_morton_sort.py')
     parser.add_argument("--sparse-loss-weight", type=float, default=1e-10,
                         help='learning rate')
     parser.add_argument("--tv-loss-weight", type=float, default=1e-4,
                         help='learning rate')
+    parser.add_argument("--tv_loss_every", type=int, default=1,
+                        help='apply the TV loss every N iterations only, with its weight scaled by N')
+    parser.add_argument("--occ_grid", action='store_true',
+                        help='skip samples in empty space using an occupancy grid per time bucket')
+    parser.add_argument("--occ_res", type=int, default=64,
+                        help='occupancy grid resolution per axis')
+    parser.add_argument("--occ_time_buckets", type=int, default=8,
+                        help='number of occupancy grids over the frame times in [0, 1]')
+    parser.add_argument("--occ_threshold", type=float, default=0.01,
+                        help='density below which an occupancy grid cell is empty')
+    parser.add_argument("--occ_update_every", type=int, default=256,
+                        help='refresh the occupancy grid from the network densities every N iterations')
+    parser.add_argument("--occ_warmup", type=int, default=256,
+                        help='keep the occupancy grid fully occupied for the first N iterations')
+    parser.add_argument("--ray_box_near_far", action='store_true',
+                        help='clip near/far of every ray to the bounding box, rays missing it render the background')
+    parser.add_argument("--grad_checkpoint", type=str, default='',
+                        help='comma separated stages recomputed in the backward to save memory: encoder (all hash/positional lookups), mlp (time net and density/color MLPs), composite (only the small per-sample compositing tensors of raw2outputs)')
+    parser.add_argument("--fused_compositing", action='store_true',
+                        help='volume rendering with a recomputing backward, saves activation memory per sample')
+    parser.add_argument("--cone_angle", type=float, default=0.,
+                        help='adaptive sampling: step = clip(distance * cone_angle, finest voxel, max_step_voxels voxels), 0 for N_samples/N_importance')
+    parser.add_argument("--max_step_voxels", type=int, default=32,
+                        help='adaptive sampling: largest step in finest hash grid voxels')
+    parser.add_argument("--reuse_coarse_samples", action='store_true',
+                        help='use one model for the coarse and fine pass and only evaluate the importance samples in the fine pass')
+    parser.add_argument("--render_budget", type=float, default=0.,
+                        help='render_only: seconds per frame for progressive preview rendering, 0 to render full frames')
+    parser.add_argument("--render_batch_frames", type=int, default=1,
+                        help='number of frames rendered together in render_path, for small images')
+    parser.add_argument("--render_outputs", type=str, default='rgb,disp,acc',
+                        help='outputs computed when rendering test views and videos, any of rgb,disp,acc,depth,sparsity (rgb is always computed)')
+    parser.add_argument("--early_termination", type=float, default=0.,
+                        help='test-time rendering: stop rays once their transmittance is below this value, 0 to disable')
+    parser.add_argument("--march_batch", type=int, default=16,
+                        help='samples per ray evaluated per marching step with --early_termination')
+    parser.add_argument("--debug_syncs", action='store_true',
+                        help='count host-device syncs per training step and report them with the console printout')
  
     return parser
 
@@ -818,9 +1475,20 @@ def train():
             os.makedirs(testsavedir, exist_ok=True)
             print('test poses shape', render_poses.shape)
 
-            rgbs, _ = render_path(render_poses, render_times, hwf, K, args.chunk, render_kwargs_test, gt_imgs=images, savedir=testsavedir, render_factor=args.render_factor, save_also_gt=True)
+            if args.render_budget > 0:
+                # previews with a fixed time per frame
+                with FrameWriter() as writer:
+                    for i, (c2w, frame_time) in enumerate(zip(tqdm(render_poses), render_times)):
+                        rgb, _, refined = render_progressive(H, W, K, c2w, frame_time, render_kwargs_test,
+                                                             args.render_budget, chunk=args.chunk)
+                        writer.write_png(os.path.join(testsavedir, '{:03d}.png'.format(i)), rgb.cpu().numpy())
+                        tqdm.write(f"[PREVIEW] frame {i}: {refined.float().mean().item():.2f} refined")
+                print('Done rendering', testsavedir)
+                return
+
+            rgbs, _ = render_path(render_poses, render_times, hwf, K, args.chunk, render_kwargs_test, gt_imgs=images, savedir=testsavedir, render_factor=args.render_factor, save_also_gt=True, batch_frames=args.render_batch_frames,
+                                  video_prefix=os.path.join(testsavedir, 'video_'))
             print('Done rendering', testsavedir)
-            imageio.mimwrite(os.path.join(testsavedir, 'video.mp4'), to8b(rgbs), fps=30, quality=8)
             
             rgbs = torch.Tensor(rgbs)
             targets = torch.Tensor(images)
@@ -836,13 +1504,14 @@ def train():
     if use_batching:
         # For random ray batching
         print('get rays')
-        rays = np.stack([get_rays_np(H, W, K, p) for p in poses[:,:3,:4]], 0) # [N, ro+rd, H, W, 3]
+        # train images only, in float32 from the start
+        rays = np.stack([get_rays_np(H, W, K, p) for p in poses[i_train,:3,:4]], 0).astype(np.float32) # [N, ro+rd, H, W, 3]
         print('done, concats')
-        rays_rgb = np.concatenate([rays, images[:,None]], 1) # [N, ro+rd+rgb, H, W, 3]
-        rays_rgb = np.transpose(rays_rgb, [0,2,3,1,4]) # [N, H, W, ro+rd+rgb, 3]
-        rays_rgb = np.stack([rays_rgb[i] for i in i_train], 0) # train images only
-        rays_rgb = np.reshape(rays_rgb, [-1,3,3]) # [(N-1)*H*W, ro+rd+rgb, 3]
-        rays_rgb = rays_rgb.astype(np.float32)
+        rays_t = np.broadcast_to(np.reshape(times[i_train], [-1,1,1,1,1]), [len(i_train),1,H,W,3]) # [N, t, H, W, 3]
+        rays_rgb = np.concatenate([rays, images[i_train,None].astype(np.float32), rays_t.astype(np.float32)], 1) # [N, ro+rd+rgb+t, H, W, 3]
+        del rays
+        rays_rgb = np.transpose(rays_rgb, [0,2,3,1,4]) # [N, H, W, ro+rd+rgb+t, 3]
+        rays_rgb = np.reshape(rays_rgb, [-1,4,3]) # [N*H*W, ro+rd+rgb+t, 3]
         print('shuffle rays')
         np.random.shuffle(rays_rgb)
 
@@ -872,13 +1541,28 @@ def train():
     time_list = []
     start = start + 1
     time0 = time.time()
+    sync_counter = HostSyncCounter(enabled=args.debug_syncs)
+    if args.i_embed==1 and args.hash_stats_every > 0:
+        render_kwargs_train["embed_fn"].start_monitoring()
+    if args.i_embed==1:
+        tv_loss_fn = TotalVariationLoss(render_kwargs_train["embed_fn"])
+    occupancy_grid = render_kwargs_train['occupancy_grid']
+    if occupancy_grid is not None:
+        density_net = render_kwargs_train['network_fine'] if render_kwargs_train['network_fine'] is not None \
+                        else render_kwargs_train['network_fn']
+        def density_fn(pts, ts):
+            viewdirs = torch.zeros_like(pts) if args.use_viewdirs else None
+            raw, _ = render_kwargs_train['network_query_fn'](pts[:,None], viewdirs, ts, density_net)
+            return raw[:,0,3]
     for i in trange(start, N_iters):
+        sync_counter.start()
+        time_step = time.time()
         # Sample random ray batch
         if use_batching:
             # Random over all images
-            batch = rays_rgb[i_batch:i_batch+N_rand] # [B, 2+1, 3*?]
+            batch = rays_rgb[i_batch:i_batch+N_rand] # [B, 2+1+1, 3*?]
             batch = torch.transpose(batch, 0, 1)
-            batch_rays, target_s = batch[:2], batch[2]
+            batch_rays, target_s, frame_time = batch[:2], batch[2], batch[3,:,0]
 
             i_batch += N_rand
             if i_batch >= rays_rgb.shape[0]:
@@ -888,16 +1572,9 @@ def train():
                 i_batch = 0
 
         else:
-            # Random from one image
-            img_i = np.random.choice(i_train)
-            target = images[img_i]
-            target = torch.Tensor(target).to(device)
-            pose = poses[img_i, :3,:4]
-            frame_time = times[img_i]
-
+            # Random from n_images_per_batch images, each ray keeps the time of its image
+            img_is = np.random.choice(i_train, size=min(args.n_images_per_batch, len(i_train)), replace=False)
             if N_rand is not None:
-                rays_o, rays_d = get_rays(H, W, K, torch.Tensor(pose))  # (H, W, 3), (H, W, 3)
-
                 if i < args.precrop_iters:
                     dH = int(H//2 * args.precrop_frac)
                     dW = int(W//2 * args.precrop_frac)
@@ -910,14 +1587,28 @@ def train():
                         print(f"[Config] Center cropping of size {2*dH} x {2*dW} is enabled until iter {args.precrop_iters}")                
                 else:
                     coords = torch.stack(torch.meshgrid(torch.linspace(0, H-1, H), torch.linspace(0, W-1, W)), -1)  # (H, W, 2)
-
                 coords = torch.reshape(coords, [-1,2])  # (H * W, 2)
-                select_inds = np.random.choice(coords.shape[0], size=[N_rand], replace=False)  # (N_rand,)
-                select_coords = coords[select_inds].long()  # (N_rand, 2)
-                rays_o = rays_o[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-                rays_d = rays_d[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-                batch_rays = torch.stack([rays_o, rays_d], 0)
-                target_s = target[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
+
+                batch_rays, target_s, frame_time = [], [], []
+                for k, img_i in enumerate(img_is):
+                    n_rays = N_rand // len(img_is) + (k < N_rand % len(img_is))
+                    target = torch.Tensor(images[img_i]).to(device)
+                    pose = poses[img_i, :3,:4]
+                    rays_o, rays_d = get_rays(H, W, K, torch.Tensor(pose))  # (H, W, 3), (H, W, 3)
+
+                    select_inds = np.random.choice(coords.shape[0], size=[n_rays], replace=False)  # (n_rays,)
+                    select_coords = coords[select_inds].long()  # (n_rays, 2)
+                    rays_o = rays_o[select_coords[:, 0], select_coords[:, 1]]  # (n_rays, 3)
+                    rays_d = rays_d[select_coords[:, 0], select_coords[:, 1]]  # (n_rays, 3)
+                    batch_rays.append(torch.stack([rays_o, rays_d], 0))
+                    target_s.append(target[select_coords[:, 0], select_coords[:, 1]])  # (n_rays, 3)
+                    frame_time.append(torch.full([n_rays], float(times[img_i])))
+                batch_rays, target_s, frame_time = torch.cat(batch_rays, 1), torch.cat(target_s, 0), torch.cat(frame_time, 0)
+
+        # coarse-to-fine: finer hash levels are neither looked up nor interpolated until switched on
+        if args.i_embed==1 and args.hash_levels_start > 0:
+            embed_fn = render_kwargs_train["embed_fn"]
+            embed_fn.n_active_levels = min(embed_fn.n_levels, args.hash_levels_start + i // args.hash_levels_every)
 
         #####  Core optimization loop  #####
         rgb, disp, acc, extras = render(H, W, K, chunk=args.chunk, rays=batch_rays, frame_time=frame_time,
@@ -926,7 +1617,6 @@ def train():
 
         optimizer.zero_grad()
         img_loss = img2mse(rgb, target_s)
-        trans = extras['raw'][...,-1]
         loss = img_loss
         psnr = mse2psnr(img_loss)
 
@@ -935,26 +1625,29 @@ def train():
             loss = loss + img_loss0
             psnr0 = mse2psnr(img_loss0)
 
-        sparsity_loss = args.sparse_loss_weight*(extras["sparsity_loss"].sum() + extras["sparsity_loss0"].sum())
+        sparsity_loss = args.sparse_loss_weight*(extras["sparsity_loss"].sum() + extras.get("sparsity_loss0", torch.zeros(1)).sum())
         loss = loss + sparsity_loss
        
-        # add Total Variation loss
-        if args.i_embed==1:
-            n_levels = render_kwargs_train["embed_fn"].n_levels
-            min_res = render_kwargs_train["embed_fn"].base_resolution
-            max_res = render_kwargs_train["embed_fn"].finest_resolution
-            log2_hashmap_size = render_kwargs_train["embed_fn"].log2_hashmap_size
-            TV_loss = sum(total_variation_loss(render_kwargs_train["embed_fn"].embeddings[i], \
-                                              min_res, max_res, \
-                                              i, log2_hashmap_size, \
-                                              n_levels=n_levels) for i in range(n_levels))
-            loss = loss + args.tv_loss_weight * TV_loss
-            if i>1000:
-                args.tv_loss_weight = 0.0
+        # add Total Variation loss, every tv_loss_every steps with the weight scaled to match
+        if args.i_embed==1 and args.tv_loss_weight > 0 and i % args.tv_loss_every == 0:
+            TV_loss = tv_loss_fn()
+            loss = loss + args.tv_loss_every * args.tv_loss_weight * TV_loss
+        if i>1000:
+            args.tv_loss_weight = 0.0
  
         loss.backward()
         # pdb.set_trace()
         optimizer.step()
+        n_syncs = sync_counter.stop()
+        if i%args.i_print==0:
+            # time of this step and peak memory since the last report, e.g. to pick --grad_checkpoint
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            time_step = time.time() - time_step
+
+        if occupancy_grid is not None and i >= args.occ_warmup and i%args.occ_update_every==0:
+            occupancy_grid.update(density_fn, chunk=args.netchunk)
+            tqdm.write(f"[OCC] Iter: {i} occupied cells per time bucket: {occupancy_grid.occupancy().tolist()}")
 
         # NOTE: IMPORTANT!
         ###   update learning rate   ###
@@ -976,27 +1669,28 @@ def train():
                 torch.save({
                     'global_step': global_step,
                     'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
-                    'network_fine_state_dict': render_kwargs_train['network_fine'].state_dict(),
+                    'network_fine_state_dict': render_kwargs_train['network_fine'].state_dict() if render_kwargs_train['network_fine'] is not None else None,
                     'embed_fn_state_dict': render_kwargs_train['embed_fn'].state_dict(),
                     'optimizer_state_dict': optimizer.state_dict(),
+                    'occupancy_grid_state_dict': occupancy_grid.state_dict() if occupancy_grid is not None else None,
                 }, path)
             else:
                 torch.save({
                     'global_step': global_step,
                     'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
-                    'network_fine_state_dict': render_kwargs_train['network_fine'].state_dict(),
+                    'network_fine_state_dict': render_kwargs_train['network_fine'].state_dict() if render_kwargs_train['network_fine'] is not None else None,
                     'optimizer_state_dict': optimizer.state_dict(),
+                    'occupancy_grid_state_dict': occupancy_grid.state_dict() if occupancy_grid is not None else None,
                 }, path)
             print('Saved checkpoints at', path)
 
         if i%args.i_video==0 and i > 0:
             # Turn on testing mode
-            with torch.no_grad():
-                rgbs, disps = render_path(render_poses, render_times, hwf, K, args.chunk, render_kwargs_test)
-            print('Done, saving', rgbs.shape, disps.shape)
             moviebase = os.path.join(basedir, expname, '{}_spiral_{:06d}_'.format(expname, i))
-            imageio.mimwrite(moviebase + 'rgb.mp4', to8b(rgbs), fps=30, quality=8)
-            imageio.mimwrite(moviebase + 'disp.mp4', to8b(disps / np.max(disps)), fps=30, quality=8)
+            with torch.no_grad():
+                render_path(render_poses, render_times, hwf, K, args.chunk, render_kwargs_test,
+                            batch_frames=args.render_batch_frames, video_prefix=moviebase, return_frames=False)
+            print('Saved videos', moviebase)
 
             # if args.use_viewdirs:
             #     render_kwargs_test['c2w_staticcam'] = render_poses[0][:3,:4]
@@ -1010,13 +1704,23 @@ def train():
             os.makedirs(testsavedir, exist_ok=True)
             print('test poses shape', poses[i_test].shape)
             with torch.no_grad():
-                render_path(torch.Tensor(poses[i_test]).to(device), render_times, hwf, K, args.chunk, render_kwargs_test, gt_imgs=images[i_test], savedir=testsavedir)
+                render_path(torch.Tensor(poses[i_test]).to(device), render_times, hwf, K, args.chunk, render_kwargs_test, gt_imgs=images[i_test], savedir=testsavedir,
+                            batch_frames=args.render_batch_frames, return_frames=False)
             print('Saved test set')
 
 
     
         if i%args.i_print==0:
             tqdm.write(f"[TRAIN] Iter: {i} Loss: {loss.item()}  PSNR: {psnr.item()}")
+            if args.debug_syncs:
+                tqdm.write(f"[TRAIN] Iter: {i} Host-device syncs: {n_syncs}")
+            if torch.cuda.is_available():
+                tqdm.write(f"[TRAIN] Iter: {i} Step time: {time_step*1000:.1f} ms  "
+                           f"Peak memory: {torch.cuda.max_memory_allocated() / 2**20:.0f} MiB")
+                torch.cuda.reset_peak_memory_stats()
+            else:
+                tqdm.write(f"[TRAIN] Iter: {i} Step time: {time_step*1000:.1f} ms")
+
             loss_list.append(loss.item())
             psnr_list.append(psnr.item())
             time_list.append(t)
@@ -1027,6 +1731,14 @@ def train():
             }
             with open(os.path.join(basedir, expname, "loss_vs_time.pkl"), "wb") as fp:
                 pickle.dump(loss_psnr_time, fp)
+
+        if args.i_embed==1 and args.hash_stats_every > 0 and i%args.hash_stats_every==0:
+            tqdm.write(f"[HASH] Iter: {i} level  res  slots  touched  collisions  grad mean / max")
+            for st in render_kwargs_train["embed_fn"].table_stats():
+                # no collision rate before the first monitored batch
+                collisions = 'n/a' if st['collision_rate'] is None else f"{st['collision_rate']:.3f}"
+                tqdm.write(f"[HASH] {st['level']:5d} {st['resolution']:4d} {st['slots']:7d} {st['touched']:7d} "
+                           f"{collisions:>10s}  {st['grad_mean']:.2e} / {st['grad_max']:.2e}")
         
         global_step += 1
 
@@ -6,6 +6,7 @@ import numpy as np
 from torch.autograd import Variable
 
 from hash_encoding import HashEmbedder, SHEncoder
+from utils import checkpointed
 
 # Misc
 img2mse = lambda x, y : torch.mean((x - y) ** 2)
@@ -66,7 +67,10 @@ def get_embedder(multires, args, i=0, input_dims=3):
     elif i==1:
         embed = HashEmbedder(bounding_box=args.bounding_box, \
                             log2_hashmap_size=args.log2_hashmap_size, \
-                            finest_resolution=args.finest_res)
+                            finest_resolution=args.finest_res, \
+                            fused_backward=args.hash_fused_backward, \
+                            dtype=getattr(torch, args.hash_dtype), \
+                            dedup=args.hash_dedup)
         out_dim = embed.out_dim
     elif i==2:
         embed = SHEncoder()
@@ -74,10 +78,27 @@ def get_embedder(multires, args, i=0, input_dims=3):
     return embed, out_dim
 
 
+# Per-ray inputs of the models. ray_indices is the ray of each point (B), or
+# an int n when every ray has n consecutive points, which needs no gather.
+def expand_to_points(per_ray, ray_indices):
+    # per_ray: N_rays x C -> B x C
+    if isinstance(ray_indices, int):
+        return per_ray.repeat_interleave(ray_indices, 0)
+    return per_ray[ray_indices]
+
+
+def add_per_ray(h, per_ray, ray_indices):
+    # h: B x C (not needed by autograd), per_ray: N_rays x C, added in place
+    if isinstance(ray_indices, int):
+        h.view(-1, ray_indices, h.shape[-1]).add_(per_ray[:, None])
+        return h
+    return h.add_(per_ray[ray_indices])
+
+
 # Model
 class DirectTemporalNeRF(nn.Module):
     def __init__(self, D=8, W=256, input_ch=3, input_ch_views=3, input_ch_time=1, output_ch=4, skips=[4],
-                 use_viewdirs=False, memory=[], embed_fn=None, zero_canonical=True):
+                 use_viewdirs=False, memory=[], embed_fn=None, zero_canonical=True, checkpoint=()):
         super(DirectTemporalNeRF, self).__init__()
         self.D = D
         self.W = W
@@ -89,6 +110,8 @@ class DirectTemporalNeRF(nn.Module):
         self.memory = memory
         self.embed_fn = embed_fn
         self.zero_canonical = zero_canonical
+        # stages recomputed in the backward: 'encoder' (embed_fn) and/or 'mlp' (time net and _occ)
+        self.checkpoint = checkpoint
 
         self._occ = NeRF(D=D, W=W, input_ch=input_ch, input_ch_views=input_ch_views,
                          output_ch=output_ch, skips=skips, use_viewdirs=use_viewdirs)
@@ -119,19 +142,24 @@ class DirectTemporalNeRF(nn.Module):
 
         return net_final(h)
 
-    def forward(self, x, ts):
+    def forward(self, x, ts, unembedded_pos=None, views=None, ray_indices=None):
+        if ray_indices is not None:
+            # views and times given per ray, expanded to the points
+            if views is not None:
+                x = torch.cat([x, expand_to_points(views, ray_indices)], -1)
+            ts = [expand_to_points(t, ray_indices) for t in ts]
         input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
         t = ts[0]
 
-        assert len(torch.unique(t[:, :1])) == 1, "Only accepts all points from same time"
-        cur_time = t[0, 0]
-        if cur_time == 0. and self.zero_canonical:
-            dx = torch.zeros_like(input_pts[:, :3])
-        else:
-            dx = self.query_time(input_pts, t, self._time, self._time_out)
-            input_pts_orig = input_pts[:, :3]
-            input_pts = self.embed_fn(input_pts_orig + dx)
-        out = self._occ(torch.cat([input_pts, input_views], dim=-1))
+        # points at t == 0 stay in the canonical space, the batch may mix times.
+        # Masked rather than branched on, which would sync with the device.
+        canonical = (t[:, 0] == 0.) & self.zero_canonical
+        mlp = lambda fn: checkpointed(fn, 'mlp' in self.checkpoint)
+        dx = mlp(self.query_time)(input_pts, t, self._time, self._time_out)
+        dx = dx * ~canonical[:, None]
+        input_pts_orig = input_pts[:, :3]
+        input_pts = checkpointed(self.embed_fn, 'encoder' in self.checkpoint)(input_pts_orig + dx)
+        out = mlp(self._occ)(torch.cat([input_pts, input_views], dim=-1))
         return out, dx
 
 class TimeNetRegression(nn.Module):
@@ -162,6 +190,8 @@ class TimeNetClassification(nn.Module):
     def __init__(self, input_ch, input_ch_time, hidden_dim, n_levels):
         super(TimeNetClassification, self).__init__()
         self.n_levels = n_levels
+        self.input_ch = input_ch
+        self.input_ch_time = input_ch_time
 
         def linear_block(in_f, *args, **kwargs): 
             return nn.Sequential( nn.Linear(in_f, hidden_dim, *args, **kwargs), nn.ReLU(), nn.Linear(hidden_dim, 9) )
@@ -173,14 +203,24 @@ class TimeNetClassification(nn.Module):
         self.register_buffer('e_const', self.e)
 
    
-    def forward(self, x, t):
+    def forward(self, x, t, ray_indices=None):
         # x is embedded 3D point position: B x input_ch
-        # t is the time step: B x input_ch_time
+        # t is the time step: B x input_ch_time, or N_rays x input_ch_time
+        # with ray_indices (see add_per_ray)
         di_levels = []
         logits = None
         for i in range(self.n_levels):
             # deformation
-            if (i == 0):
+            if ray_indices is not None:
+                # the time term of the first linear is computed once per ray
+                first = self.deform_layers[i][0]
+                w_x, w_t, w_logits = torch.split(first.weight, [self.input_ch, self.input_ch_time,
+                                                                first.in_features - self.input_ch - self.input_ch_time], -1)
+                h = add_per_ray(F.linear(x, w_x), F.linear(t, w_t, first.bias), ray_indices)
+                if i > 0:
+                    h = torch.addmm(h, logits, w_logits.t())
+                logits   = self.deform_layers[i][2](F.relu(h))
+            elif (i == 0):
                 logits   = self.deform_layers[i](torch.cat([x, t], -1))
             else:
                 logits   = self.deform_layers[i](torch.cat([x, t, logits], -1))
@@ -194,7 +234,8 @@ class TimeNetClassification(nn.Module):
 class DirectTemporalNeRFSmall(nn.Module):
     def __init__(self, num_layers=3, hidden_dim=64, geo_feat_dim=15, num_layers_color=4, hidden_dim_color=64,
                  input_ch=3, input_ch_views=3, input_ch_time=1, output_ch=4, skips=[4],
-                 use_viewdirs=False, memory=[], embed_fn=None, zero_canonical=True, use_classification=True):
+                 use_viewdirs=False, memory=[], embed_fn=None, zero_canonical=True, use_classification=True,
+                 checkpoint=()):
         super(DirectTemporalNeRFSmall, self).__init__()
         self.num_layers = num_layers
         self.hidden_dim = hidden_dim
@@ -210,6 +251,8 @@ class DirectTemporalNeRFSmall(nn.Module):
         self.embed_fn = embed_fn
         self.zero_canonical = zero_canonical
         self.use_classification = use_classification
+        # stages recomputed in the backward: 'encoder' (embed_fn) and/or 'mlp' (time_net and _occ)
+        self.checkpoint = checkpoint
 
         self._occ = NeRFSmall(num_layers=num_layers, hidden_dim=hidden_dim, geo_feat_dim=geo_feat_dim,
                               num_layers_color=num_layers_color, hidden_dim_color=hidden_dim_color,
@@ -221,24 +264,41 @@ class DirectTemporalNeRFSmall(nn.Module):
             self.time_net = TimeNetRegression(input_ch, input_ch_time, hidden_dim, num_layers, skips)
 
 
-    def forward(self, x, ts, unembedded_pos):
-        input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
+    def forward(self, x, ts, unembedded_pos, views=None, ray_indices=None):
+        '''
+        x: B x (input_ch + input_ch_views) embedded points and views, ts: [B x input_ch_time] * 2
+        With ray_indices (see add_per_ray), x is only the embedded
+        points, views (N_rays x input_ch_views) and ts ([N_rays x input_ch_time] * 2)
+        are per ray and broadcast in the first layers of the nets.
+        '''
+        if ray_indices is None:
+            input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
+        else:
+            input_pts, input_views = x, views
         t = ts[0]
 
-        assert len(torch.unique(t[:, :1])) == 1, "Only accepts all points from same time"
-        cur_time = t[0, 0]
-        if cur_time == 0. and self.zero_canonical:
-            dx = torch.zeros_like(input_pts[:, :3])
+        # points at t == 0 stay in the canonical space, the batch may mix times.
+        # Masked rather than branched on, which would sync with the device.
+        canonical = (t[:, 0] == 0.) & self.zero_canonical
+        if ray_indices is not None:
+            canonical = expand_to_points(canonical, ray_indices)
+        embed_fn = checkpointed(self.embed_fn, 'encoder' in self.checkpoint)
+        time_net = checkpointed(self.time_net, 'mlp' in self.checkpoint)
+        occ = checkpointed(self._occ, 'mlp' in self.checkpoint)
+        if self.use_classification:
+            di_levels = time_net(input_pts, t, ray_indices=ray_indices)
+            di_levels = di_levels * ~canonical[None, :, None]
+            input_pts = embed_fn(unembedded_pos, di_levels=di_levels)
+            dx = torch.zeros_like(input_pts[:, :3]) # actually no use
         else:
-            if self.use_classification:
-                di_levels = self.time_net(input_pts, t)
-                input_pts = self.embed_fn(unembedded_pos, di_levels=di_levels)
-                dx = torch.zeros_like(input_pts[:, :3]) # actually no use
-            else:
-                dx = self.time_net(input_pts, t)
-                #input_pts_orig = input_pts[:, :3]
-                input_pts = self.embed_fn(unembedded_pos + dx)
-        out = self._occ(torch.cat([input_pts, input_views], dim=-1))
+            dx = time_net(input_pts, t if ray_indices is None else expand_to_points(t, ray_indices))
+            dx = dx * ~canonical[:, None]
+            #input_pts_orig = input_pts[:, :3]
+            input_pts = embed_fn(unembedded_pos + dx)
+        if ray_indices is None:
+            out = occ(torch.cat([input_pts, input_views], dim=-1))
+        else:
+            out = occ(input_pts, views=input_views, ray_indices=ray_indices)
         return out, dx
 
 class NeRF(nn.Module):
@@ -382,8 +442,13 @@ class NeRFSmall(nn.Module):
 
         self.color_net = nn.ModuleList(color_net)
     
-    def forward(self, x):
-        input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
+    def forward(self, x, views=None, ray_indices=None):
+        # x: B x (input_ch + input_ch_views), or B x input_ch with the views
+        # given per ray (N_rays x input_ch_views) and ray_indices (see add_per_ray)
+        if views is None:
+            input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
+        else:
+            input_pts = x
 
         # sigma
         h = input_pts
@@ -395,9 +460,15 @@ class NeRFSmall(nn.Module):
         sigma, geo_feat = h[..., 0], h[..., 1:]
         
         # color
-        h = torch.cat([input_views, geo_feat], dim=-1)
+        if views is None:
+            h = torch.cat([input_views, geo_feat], dim=-1)
         for l in range(self.num_layers_color):
-            h = self.color_net[l](h)
+            if l == 0 and views is not None:
+                # the view term of the first layer is computed once per ray
+                w_views, w_geo = torch.split(self.color_net[0].weight, [self.input_ch_views, self.geo_feat_dim], dim=-1)
+                h = add_per_ray(F.linear(geo_feat, w_geo), F.linear(views, w_views), ray_indices)
+            else:
+                h = self.color_net[l](h)
             if l != self.num_layers_color - 1:
                 h = F.relu(h, inplace=True)
             
@@ -453,8 +524,33 @@ def ndc_rays(H, W, focal, near, rays_o, rays_d):
     return rays_o, rays_d
 
 
+def ray_box_intersection(rays_o, rays_d, box_min, box_max):
+    '''
+    Slab test of every ray against an axis-aligned box.
+    rays_o, rays_d: N_rays x 3
+    returns t_min, t_max: N_rays x 1, the ray enters the box at t_min and
+    leaves it at t_max. The ray misses the box if t_max <= t_min.
+    '''
+    # avoid inf * 0 for rays parallel to a slab
+    rays_d = torch.where(rays_d.abs() < 1e-10, torch.full_like(rays_d, 1e-10), rays_d)
+    t0 = (box_min.to(rays_o) - rays_o) / rays_d
+    t1 = (box_max.to(rays_o) - rays_o) / rays_d
+    t_min = torch.minimum(t0, t1).max(dim=-1, keepdim=True)[0]
+    t_max = torch.maximum(t0, t1).min(dim=-1, keepdim=True)[0]
+    return t_min, t_max
+
+
 # Hierarchical sampling (section 5.2)
-def sample_pdf(bins, weights, N_samples, det=False, pytest=False):
+def sample_pdf(bins, weights, N_samples, det=False, pytest=False, stratified=False):
+    '''
+    Inverse transform sampling of the piecewise constant pdf given by weights.
+    bins: [batch, M+1], weights: [batch, M]
+    det: evenly spaced u. stratified: one random u in each of the N_samples
+    equal strata of [0, 1) (sorted). Otherwise u is iid uniform.
+    The bracketing cdf and bin values are gathered directly with the
+    searchsorted indices, memory is O(batch * N_samples).
+    returns: [batch, N_samples]
+    '''
     # Get pdf
     weights = weights + 1e-5 # prevent nans
     pdf = weights / torch.sum(weights, -1, keepdim=True)
@@ -465,6 +561,8 @@ def sample_pdf(bins, weights, N_samples, det=False, pytest=False):
     if det:
         u = torch.linspace(0., 1., steps=N_samples)
         u = u.expand(list(cdf.shape[:-1]) + [N_samples])
+    elif stratified:
+        u = (torch.arange(N_samples) + torch.rand(list(cdf.shape[:-1]) + [N_samples])) / N_samples
     else:
         u = torch.rand(list(cdf.shape[:-1]) + [N_samples])
 
@@ -482,19 +580,62 @@ def sample_pdf(bins, weights, N_samples, det=False, pytest=False):
     # Invert CDF
     u = u.contiguous()
     inds = torch.searchsorted(cdf, u, right=True)
-    below = torch.max(torch.zeros_like(inds-1), inds-1)
-    above = torch.min((cdf.shape[-1]-1) * torch.ones_like(inds), inds)
-    inds_g = torch.stack([below, above], -1)  # (batch, N_samples, 2)
+    below = torch.clamp(inds-1, min=0)
+    above = torch.clamp(inds, max=cdf.shape[-1]-1)
+    inds_g = torch.cat([below, above], -1)  # (batch, 2*N_samples)
 
-    # cdf_g = tf.gather(cdf, inds_g, axis=-1, batch_dims=len(inds_g.shape)-2)
-    # bins_g = tf.gather(bins, inds_g, axis=-1, batch_dims=len(inds_g.shape)-2)
-    matched_shape = [inds_g.shape[0], inds_g.shape[1], cdf.shape[-1]]
-    cdf_g = torch.gather(cdf.unsqueeze(1).expand(matched_shape), 2, inds_g)
-    bins_g = torch.gather(bins.unsqueeze(1).expand(matched_shape), 2, inds_g)
+    cdf_g = torch.gather(cdf, -1, inds_g)
+    bins_g = torch.gather(bins, -1, inds_g)
+    cdf_below, cdf_above = cdf_g[...,:N_samples], cdf_g[...,N_samples:]
+    bins_below, bins_above = bins_g[...,:N_samples], bins_g[...,N_samples:]
 
-    denom = (cdf_g[...,1]-cdf_g[...,0])
+    denom = (cdf_above-cdf_below)
     denom = torch.where(denom<1e-5, torch.ones_like(denom), denom)
-    t = (u-cdf_g[...,0])/denom
-    samples = bins_g[...,0] + t * (bins_g[...,1]-bins_g[...,0])
+    t = (u-cdf_below)/denom
+    samples = bins_below + t * (bins_above-bins_below)
 
     return samples
+
+
+# Packed samples
+# A variable number of samples per ray is stored flat, ray by ray:
+#   ray_indices: [N] ray of every sample (non-decreasing)
+#   offsets: [N_rays+1] samples of ray r are [offsets[r], offsets[r+1])
+def pack_counts(counts):
+    '''
+    counts: [N_rays] number of samples per ray
+    returns ray_indices [N], offsets [N_rays+1]
+    '''
+    counts = counts.long()
+    ray_indices = torch.repeat_interleave(torch.arange(len(counts), device=counts.device), counts)
+    offsets = torch.cat([counts.new_zeros(1), torch.cumsum(counts, 0)])
+    return ray_indices, offsets
+
+
+def pack_mask(mask):
+    '''
+    mask: [N_rays, N_samples] bool, samples to keep
+    returns ray_indices [N], offsets [N_rays+1]; x[mask] is the packed x
+    '''
+    return pack_counts(mask.sum(-1))
+
+
+def segment_cumsum(x, ray_indices, offsets, exclusive=False):
+    '''
+    Cumulative sum of x within every ray. Accumulates in float64, so that
+    the running sum over all previous rays does not eat the precision.
+    x: [N]
+    '''
+    cs = torch.cumsum(x.double(), 0)
+    start = torch.cat([cs.new_zeros(1), cs])[offsets[:-1]] # sum over all previous rays, [N_rays]
+    if exclusive:
+        cs = cs - x.double()
+    return (cs - start[ray_indices]).to(x.dtype)
+
+
+def segment_sum(x, ray_indices, n_rays):
+    '''
+    x: [N, ...]
+    returns [n_rays, ...]
+    '''
+    return x.new_zeros([n_rays] + list(x.shape[1:])).index_add(0, ray_indices, x)
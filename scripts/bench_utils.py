@@ -0,0 +1,59 @@
+# Shared helpers for the benchmark scripts. Run them from the repository root,
+# e.g. python scripts/benchmark_hash_dedup.py --config configs/lego.txt
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+
+import numpy as np
+import torch
+
+from run_nerf import config_parser
+from run_nerf_helpers import get_rays
+from load_blender import load_blender_data
+
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def load_scene(parser=None):
+    parser = config_parser() if parser is None else parser
+    args = parser.parse_args()
+    images, poses, times, _, _, hwf, i_split, bounding_box = load_blender_data(args.datadir, args.half_res, args.testskip)
+    args.bounding_box = bounding_box
+    H, W, focal = hwf
+    H, W = int(H), int(W)
+    K = np.array([
+        [focal, 0, 0.5*W],
+        [0, focal, 0.5*H],
+        [0, 0, 1]
+    ])
+    return args, torch.Tensor(poses), torch.Tensor(times), H, W, K, i_split[0]
+
+
+def sample_training_points(poses, i_train, H, W, K, N_rand, N_samples, near=2., far=6.):
+    """Stratified samples of N_rand random rays of one training image, like one
+    step of train() with no_batching. Returns [N_rand * N_samples, 3].
+    """
+    img_i = np.random.choice(i_train)
+    rays_o, rays_d = get_rays(H, W, K, poses[img_i, :3, :4])
+    select_inds = np.random.choice(H*W, size=[N_rand], replace=False)
+    rays_o = rays_o.reshape(-1, 3)[select_inds]
+    rays_d = rays_d.reshape(-1, 3)[select_inds]
+
+    t_vals = torch.linspace(0., 1., steps=N_samples+1)[:-1]
+    t_vals = t_vals + torch.rand([N_rand, N_samples]) / N_samples
+    z_vals = near * (1.-t_vals) + far * t_vals
+    pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None]
+    return pts.reshape(-1, 3)
+
+
+def timeit(fn, n_iters=5, n_warmup=1):
+    for _ in range(n_warmup):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    t = time.time()
+    for _ in range(n_iters):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - t) / n_iters
@@ -0,0 +1,43 @@
+# Reports how often the hash encoding reads the same table row within one
+# training batch, per level, and the gather time with and without --hash_dedup.
+#
+#   python scripts/benchmark_hash_dedup.py --config configs/lego.txt
+from bench_utils import *
+
+from run_nerf_helpers import get_embedder
+
+
+def main():
+    parser = config_parser()
+    parser.add_argument("--n_batches", type=int, default=10,
+                        help='number of training batches to average over')
+    args, poses, times, H, W, K, i_train = load_scene(parser)
+
+    embed_fn, _ = get_embedder(args.multires, args, i=1)
+    N_samples = args.N_samples + args.N_importance
+
+    n_levels = embed_fn.n_levels
+    n_lookups = torch.zeros(n_levels)
+    n_unique = torch.zeros(n_levels)
+    for _ in range(args.n_batches):
+        pts = sample_training_points(poses, i_train, H, W, K, args.N_rand, N_samples)
+        _, _, voxel_indices = embed_fn.voxel_vertices(pts)
+        for l in range(n_levels):
+            n_lookups[l] += voxel_indices[l].numel()
+            n_unique[l] += len(torch.unique(voxel_indices[l]))
+
+    print(f"{args.N_rand} rays x {N_samples} samples per batch, log2T {args.log2_hashmap_size}, finest res {args.finest_res}")
+    print("level  res  storage  lookups/unique")
+    for l in range(n_levels):
+        storage = "dense" if l < embed_fn.n_dense_levels else "hashed"
+        print(f"{l:5d} {int(embed_fn.resolutions[l]):4d}  {storage:7s}  {(n_lookups[l]/n_unique[l]).item():8.2f}")
+    print(f"total  {(n_lookups.sum()/n_unique.sum()).item():.2f}")
+
+    for dedup in [False, True]:
+        embed_fn.dedup = dedup
+        dt = timeit(lambda: embed_fn(pts).sum().backward())
+        print(f"dedup={dedup}: forward+backward {dt*1000:.1f} ms")
+
+
+if __name__=='__main__':
+    main()
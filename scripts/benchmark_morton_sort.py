@@ -0,0 +1,44 @@
+# Encoder throughput (forward+backward) on training samples in ray order vs.
+# sorted in Morton order (sort and unsort included), for several table sizes.
+#
+#   python scripts/benchmark_morton_sort.py --config configs/lego.txt
+from bench_utils import *
+
+from hash_encoding import HashEmbedder
+from utils import morton_code
+
+
+def main():
+    parser = config_parser()
+    parser.add_argument("--log2_sizes", type=int, nargs='+', default=[14, 16, 18, 19, 20, 22],
+                        help='log2_hashmap_size values to benchmark')
+    args, poses, times, H, W, K, i_train = load_scene(parser)
+
+    pts = sample_training_points(poses, i_train, H, W, K, args.N_rand, args.N_samples + args.N_importance)
+    pts = pts.to(device)
+    box_min, box_max = [b.to(device) for b in args.bounding_box]
+
+    def step(embed_fn, sort):
+        x = pts
+        if sort:
+            order = torch.argsort(morton_code(x, box_min, box_max))
+            x = x[order]
+        out = embed_fn(x)
+        if sort:
+            inverse_order = torch.empty_like(order)
+            inverse_order[order] = torch.arange(order.shape[0], device=order.device)
+            out = out[inverse_order]
+        out.sum().backward()
+
+    print(f"{pts.shape[0]} samples, finest res {args.finest_res}")
+    print("log2T  ray order (samples/s)  morton order (samples/s)  speedup")
+    for log2_hashmap_size in args.log2_sizes:
+        embed_fn = HashEmbedder(bounding_box=(box_min, box_max), log2_hashmap_size=log2_hashmap_size,
+                                finest_resolution=args.finest_res).to(device)
+        t_ray = timeit(lambda: step(embed_fn, False))
+        t_morton = timeit(lambda: step(embed_fn, True))
+        print(f"{log2_hashmap_size:5d}  {pts.shape[0]/t_ray:22.0f}  {pts.shape[0]/t_morton:24.0f}  {t_ray/t_morton:7.2f}x")
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,56 @@
+# Recommends the smallest log2_hashmap_size whose hash collision rate stays under
+# a target on every level, for the sample distribution of a dataset.
+#
+#   python scripts/recommend_hash_size.py --config configs/lego.txt --finest_res 1024 --target_collision 0.1
+from bench_utils import *
+
+from hash_encoding import HashEmbedder
+from utils import get_voxel_bottom_left, unique_voxel_vertices, hash_collision_rate
+
+
+def main():
+    parser = config_parser()
+    parser.add_argument("--n_batches", type=int, default=20,
+                        help='number of training batches sampled to estimate the occupied vertices')
+    parser.add_argument("--target_collision", type=float, default=0.1,
+                        help='largest acceptable collision rate on any hashed level')
+    parser.add_argument("--log2_range", type=int, nargs=2, default=[12, 24],
+                        help='smallest and largest log2_hashmap_size to consider')
+    args, poses, times, H, W, K, i_train = load_scene(parser)
+
+    # only used for its grid constants, the smallest table is enough
+    embed_fn = HashEmbedder(bounding_box=args.bounding_box, log2_hashmap_size=args.log2_range[0],
+                            finest_resolution=args.finest_res)
+    n_levels = embed_fn.n_levels
+
+    vertices = [None] * n_levels
+    for _ in range(args.n_batches):
+        pts = sample_training_points(poses, i_train, H, W, K, args.N_rand, args.N_samples + args.N_importance)
+        bottom_left_idx = get_voxel_bottom_left(pts, embed_fn.box_min, embed_fn.box_max,
+                                                embed_fn.grid_size, embed_fn.idx_max)
+        vertices = [unique_voxel_vertices(bottom_left_idx[l], vertices[l]) for l in range(n_levels)]
+
+    print(f"{args.n_batches} batches of {args.N_rand} rays x {args.N_samples + args.N_importance} samples, finest res {args.finest_res}")
+    print("level  res  occupied vertices")
+    for l in range(n_levels):
+        print(f"{l:5d} {int(embed_fn.resolutions[l]):4d}  {len(vertices[l]):10d}")
+
+    print("log2T  table MB  worst collision  mean collision")
+    recommended = None
+    for log2_hashmap_size in range(args.log2_range[0], args.log2_range[1]+1):
+        dense = embed_fn.grid_sides.prod(-1) <= 2**log2_hashmap_size
+        rates = [0. if dense[l] else hash_collision_rate(vertices[l], log2_hashmap_size) for l in range(n_levels)]
+        rows = sum(int(embed_fn.grid_sides[l].prod()) if dense[l] else 2**log2_hashmap_size for l in range(n_levels))
+        table_mb = rows * embed_fn.n_features_per_level * 4 / 2**20
+        print(f"{log2_hashmap_size:5d} {table_mb:9.1f} {max(rates):16.3f} {np.mean(rates):15.3f}")
+        if recommended is None and max(rates) <= args.target_collision:
+            recommended = log2_hashmap_size
+
+    if recommended is None:
+        print(f"No table size in {args.log2_range} keeps collisions under {args.target_collision}")
+    else:
+        print(f"Recommended: --log2_hashmap_size {recommended} (collisions <= {args.target_collision} on every level)")
+
+
+if __name__=='__main__':
+    main()
@@ -2,12 +2,16 @@ import json
 import numpy as np
 import pdb
 import torch
+import torch.utils.checkpoint
+import warnings
 
 from ray_utils import get_rays, get_ray_directions
 
 
 BOX_OFFSETS = torch.tensor([[[i,j,k] for i in [0, 1] for j in [0, 1] for k in [0, 1]]],
-                               device='cuda')
+                               device='cuda' if torch.cuda.is_available() else 'cpu')
+HASH_PRIMES = torch.tensor([73856093, 19349663, 83492791], dtype=torch.int32, device=BOX_OFFSETS.device)
+CORNER_OFFSETS = BOX_OFFSETS[0, [0, 7]].T.int() # 3 x 2
 
 def hash(coords, log2_hashmap_size):
     '''
@@ -18,6 +22,64 @@ def hash(coords, log2_hashmap_size):
     return ((1<<log2_hashmap_size)-1) & (x*73856093 ^ y*19349663 ^ z*83492791)
 
 
+def hash_voxel_corners(bottom_left_idx, log2_hashmap_size):
+    '''
+    Same as hash() on bottom_left_idx + BOX_OFFSETS, but each axis is multiplied
+    only for its 2 corner values and the 8 corners are combined by broadcasting.
+    Works in int32: products wrap around, but the low log2_hashmap_size bits
+    are the same as with int64.
+    bottom_left_idx: ... x 3 (int32)
+    returns: ... x 8 (ordered 000,001,010,011,100,101,110,111)
+    '''
+    corners = bottom_left_idx.unsqueeze(-1) + CORNER_OFFSETS # ... x 3 x 2
+    h = corners * HASH_PRIMES[:, None]
+    h = h[..., 0, :, None, None] ^ h[..., 1, None, :, None] ^ h[..., 2, None, None, :] # ... x 2 x 2 x 2
+    return ((1<<log2_hashmap_size)-1) & h.flatten(-3)
+
+
+def dense_voxel_corners(bottom_left_idx, strides):
+    '''
+    Linear indices of the 8 voxel corners in a dense grid, no hashing.
+    bottom_left_idx: ... x 3 (int32)
+    strides: row stride of each axis, broadcastable to ... x 3
+    returns: ... x 8 (ordered 000,001,010,011,100,101,110,111)
+    '''
+    corners = bottom_left_idx.unsqueeze(-1) + CORNER_OFFSETS # ... x 3 x 2
+    h = corners * strides[..., None]
+    h = h[..., 0, :, None, None] + h[..., 1, None, :, None] + h[..., 2, None, None, :] # ... x 2 x 2 x 2
+    return h.flatten(-3)
+
+
+def voxel_corner_indices(bottom_left_idx, log2_hashmap_size, dense_strides=None):
+    '''
+    Table indices of the 8 voxel corners, local to each level.
+    bottom_left_idx: (L x) B x 3
+    dense_strides: L_dense x 3. If given, the first L_dense levels are indexed
+                   as dense grids and only the remaining levels are hashed.
+    '''
+    if dense_strides is None:
+        return hash_voxel_corners(bottom_left_idx, log2_hashmap_size)
+    n_dense = dense_strides.shape[0]
+    dense = dense_voxel_corners(bottom_left_idx[:n_dense], dense_strides[:,None,:])
+    hashed = hash_voxel_corners(bottom_left_idx[n_dense:], log2_hashmap_size)
+    return torch.cat([dense, hashed], 0)
+
+
+def morton_code(xyz, box_min, box_max, bits=10):
+    '''
+    Z-order code of the points, quantized to a 2**bits grid over the box.
+    xyz: B x 3
+    bits: at most 10
+    returns: B (int64)
+    '''
+    assert bits <= 10
+    grid = ((xyz - box_min) / (box_max - box_min) * (1<<bits)).long().clamp(0, (1<<bits)-1)
+    # spread the bits of each axis to every third bit
+    for shift, mask in [(16, 0x030000FF), (8, 0x0300F00F), (4, 0x030C30C3), (2, 0x09249249)]:
+        grid = (grid | (grid << shift)) & mask
+    return (grid[..., 0] << 2) | (grid[..., 1] << 1) | grid[..., 2]
+
+
 def get_bbox3d_for_blenderobj(camera_transforms, H, W, near=2.0, far=6.0):
     camera_angle_x = float(camera_transforms['camera_angle_x'])
     focal = 0.5*W/np.tan(0.5 * camera_angle_x)
@@ -52,11 +114,14 @@ def get_bbox3d_for_blenderobj(camera_transforms, H, W, near=2.0, far=6.0):
     return (torch.tensor(min_bound)-torch.tensor([1.0,1.0,1.0]), torch.tensor(max_bound)+torch.tensor([1.0,1.0,1.0]))
 
 
-def get_voxel_vertices(xyz, bounding_box, resolution, log2_hashmap_size, di=None):
+def get_voxel_vertices(xyz, bounding_box, resolution, log2_hashmap_size, di=None, dense_strides=None):
     '''
     xyz: 3D coordinates of samples. B x 3
     bounding_box: min and max x,y,z coordinates of object bbox
-    resolution: number of voxels per axis
+    resolution: number of voxels per axis. Scalar, or a tensor of shape L to
+                compute all L levels at once (outputs then get a leading L dim)
+    di: integer voxel offsets added to the bottom-left index. B x 3 (L x B x 3)
+    dense_strides: see voxel_corner_indices
     '''
     box_min, box_max = bounding_box
 
@@ -65,21 +130,21 @@ def get_voxel_vertices(xyz, bounding_box, resolution, log2_hashmap_size, di=None
         # pdb.set_trace()
         xyz = torch.clamp(xyz, min=box_min, max=box_max)
 
-    grid_size = (box_max-box_min)/resolution
+    resolution = torch.as_tensor(resolution, device=xyz.device)
+    grid_size = (box_max-box_min)/resolution[...,None,None] # (L x) 1 x 3
     
     bottom_left_idx = torch.floor((xyz-box_min)/grid_size).int()
-    di = torch.full_like(bottom_left_idx, 999999)
     if di is not None:
         bottom_left_idx += di
 
-    idx_min = torch.Tensor([0,0,0]).int()
+    idx_min = torch.zeros(3, dtype=torch.int32, device=xyz.device)
     idx_max = torch.floor((box_max-box_min)/grid_size).int()
     
     if not torch.all(bottom_left_idx <= idx_max) or not torch.all(bottom_left_idx >= idx_min):
         bottom_left_idx = torch.clamp(bottom_left_idx, min=idx_min, max=idx_max)
     
     voxel_min_vertex = bottom_left_idx*grid_size + box_min
-    voxel_max_vertex = voxel_min_vertex + torch.tensor([1.0,1.0,1.0])*grid_size
+    voxel_max_vertex = voxel_min_vertex + grid_size
 
     # hashed_voxel_indices = [] # B x 8 ... 000,001,010,011,100,101,110,111
     # for i in [0, 1]:
@@ -89,12 +154,130 @@ def get_voxel_vertices(xyz, bounding_box, resolution, log2_hashmap_size, di=None
     #             # vertex = bottom_left + torch.tensor([i,j,k])*grid_size
     #             hashed_voxel_indices.append(hash(vertex_idx, log2_hashmap_size))
 
-    voxel_indices = bottom_left_idx.unsqueeze(1) + BOX_OFFSETS
-    hashed_voxel_indices = hash(voxel_indices, log2_hashmap_size)
+    # voxel_indices = bottom_left_idx.unsqueeze(-2) + BOX_OFFSETS
+    # hashed_voxel_indices = hash(voxel_indices, log2_hashmap_size)
+    hashed_voxel_indices = voxel_corner_indices(bottom_left_idx, log2_hashmap_size, dense_strides) # (L x) B x 8
 
     return voxel_min_vertex, voxel_max_vertex, hashed_voxel_indices
 
 
+def get_voxel_bottom_left(xyz, box_min, box_max, grid_size, idx_max, di=None):
+    '''
+    Bottom-left voxel index of the samples on every level, clamped to the grid.
+    Arguments as in get_voxel_vertices_precomputed. Returns L x B x 3 (int32)
+    '''
+    xyz = torch.clamp(xyz, min=box_min, max=box_max)
+
+    bottom_left_idx = torch.floor((xyz-box_min)/grid_size).int()
+    if di is not None:
+        bottom_left_idx += di
+    bottom_left_idx = torch.clamp(bottom_left_idx, min=0)
+    return torch.minimum(bottom_left_idx, idx_max)
+
+
+def get_voxel_vertices_precomputed(xyz, box_min, box_max, grid_size, idx_max, log2_hashmap_size, di=None,
+                                   dense_strides=None):
+    '''
+    Same as get_voxel_vertices, but with the per-level grid constants computed
+    once by the caller and both clamps applied unconditionally, so that no
+    torch.all() has to be read back by the host.
+    xyz: 3D coordinates of samples. B x 3
+    box_min, box_max: 3
+    grid_size: voxel size per level. L x 1 x 3
+    idx_max: largest bottom-left voxel index per level. L x 1 x 3
+    di: integer voxel offsets added to the bottom-left index. L x B x 3
+    dense_strides: see voxel_corner_indices
+    '''
+    bottom_left_idx = get_voxel_bottom_left(xyz, box_min, box_max, grid_size, idx_max, di)
+
+    voxel_min_vertex = bottom_left_idx*grid_size + box_min
+    voxel_max_vertex = voxel_min_vertex + grid_size
+
+    hashed_voxel_indices = voxel_corner_indices(bottom_left_idx, log2_hashmap_size, dense_strides) # L x B x 8
+
+    return voxel_min_vertex, voxel_max_vertex, hashed_voxel_indices
+
+
+def unique_voxel_vertices(bottom_left_idx, vertices=None):
+    '''
+    Distinct vertices of the voxels with the given bottom-left indices.
+    bottom_left_idx: B x 3
+    vertices: N x 3 distinct vertices found so far, merged into the result
+    returns: M x 3 (int64)
+    '''
+    new_vertices = (bottom_left_idx.long().unsqueeze(-2) + BOX_OFFSETS).reshape(-1, 3)
+    if vertices is not None:
+        new_vertices = torch.cat([vertices, new_vertices.to(vertices.device)], 0)
+    # pack into a single int64 key (21 bits per axis) for a fast 1D unique
+    keys = new_vertices[:, 0] | (new_vertices[:, 1] << 21) | (new_vertices[:, 2] << 42)
+    keys = torch.unique(keys)
+    mask = (1 << 21) - 1
+    return torch.stack([keys & mask, (keys >> 21) & mask, keys >> 42], -1)
+
+
+def hash_collision_rate(vertices, log2_hashmap_size):
+    '''
+    Fraction of the distinct vertices that do not get a hash table slot of
+    their own, i.e. 1 - (slots used) / (vertices).
+    vertices: N x 3 distinct vertices
+    '''
+    if len(vertices) == 0:
+        return 0.
+    n_slots = len(torch.unique(hash(vertices, log2_hashmap_size)))
+    return 1. - n_slots / len(vertices)
+
+
+class HostSyncCounter:
+    '''
+    Counts the host-device synchronizations triggered between start() and
+    stop(), using the warnings emitted by torch.cuda.set_sync_debug_mode.
+    Always reports 0 without CUDA or when disabled.
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled and torch.cuda.is_available()
+        self._catcher = None
+        self._caught = None
+        self._prev_mode = None
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._catcher = warnings.catch_warnings(record=True)
+        self._caught = self._catcher.__enter__()
+        warnings.simplefilter("always")
+        self._prev_mode = torch.cuda.get_sync_debug_mode()
+        torch.cuda.set_sync_debug_mode("warn")
+
+    def stop(self):
+        if not self.enabled or self._catcher is None:
+            return 0
+        torch.cuda.set_sync_debug_mode(self._prev_mode)
+        self._catcher.__exit__(None, None, None)
+        self._catcher = None
+
+        n_syncs = 0
+        for w in self._caught:
+            if "synchronizing" in str(w.message):
+                n_syncs += 1
+            else:
+                warnings.warn_explicit(w.message, w.category, w.filename, w.lineno)
+        return n_syncs
+
+
+def checkpointed(fn, enabled=True):
+    '''
+    Wraps fn in gradient checkpointing: its activations are freed after the
+    forward and recomputed (with the same RNG state) in the backward.
+    Without grad, or when not enabled, fn runs as is.
+    '''
+    if not enabled:
+        return fn
+    def ret(*args, **kwargs):
+        if not torch.is_grad_enabled():
+            return fn(*args, **kwargs)
+        return torch.utils.checkpoint.checkpoint(fn, *args, use_reentrant=False, **kwargs)
+    return ret
+
 
 if __name__=="__main__":
     with open("data/nerf_synthetic/chair/transforms_train.json", "r") as f: